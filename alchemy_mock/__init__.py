@@ -1,4 +1,18 @@
 # -*- coding: utf-8 -*-
+"""
+SQLAlchemy mock helpers.
+
+Importing alchemy_mock is cheap since SQLAlchemy is only imported
+when it is first needed::
+
+    >>> import subprocess, sys
+    >>> print(subprocess.check_output([
+    ...     sys.executable, '-c',
+    ...     'import sys, alchemy_mock.mocking, alchemy_mock.unittests; '
+    ...     'print(sorted(m for m in sys.modules if m.startswith("sqlalchemy")))',
+    ... ]).decode('utf-8').strip())
+    []
+"""
 from __future__ import absolute_import, print_function, unicode_literals
 
 
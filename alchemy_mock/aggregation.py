@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+"""
+Evaluation of aggregate queries over rows stored in mock data
+
+Queries of aggregate functions such as
+``query(func.count(Model.id)).filter(...)`` are evaluated over rows
+which ``query(Model).filter(...)`` would return. Rows are aggregated
+in a single pass and ``group_by`` groups rows in a hash map
+hence evaluating aggregates of ``N`` rows costs ``O(N)``.
+Only ``count``, ``sum``, ``min``, ``max`` and ``avg`` of columns
+of a single model are evaluated.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import collections
+from operator import itemgetter
+
+from .compact import CompactRows, FilteredRows
+
+
+_MISSING = object()
+
+
+class ExistsResult(object):
+    """
+    Result of ``query.exists()`` which can be queried
+    for its value with ``session.query(exists).scalar()``
+
+    For example::
+
+        >>> ExistsResult(True)
+        ExistsResult(True)
+    """
+
+    __slots__ = ["exists"]
+
+    def __init__(self, exists):
+        self.exists = exists
+
+    def __repr__(self):
+        return "ExistsResult({!r})".format(self.exists)
+
+
+def scalar_value(row):
+    """
+    Get first column of given result row
+
+    For example::
+
+        >>> scalar_value((1, 2)), scalar_value('foo')
+        (1, 'foo')
+    """
+    if isinstance(row, tuple):
+        return row[0]
+    return row
+
+
+def get_column(expression):
+    """
+    Get ``(model, attribute name)`` of mapped column expression
+    or ``None`` when expression is not a mapped column
+
+    For example::
+
+        >>> from sqlalchemy import Column, Integer, String, func
+        >>> from sqlalchemy.ext.declarative import declarative_base
+        >>> from sqlalchemy.orm import aliased
+
+        >>> Base = declarative_base()
+
+        >>> class SomeClass(Base):
+        ...     __tablename__ = 'some_table'
+        ...     pk1 = Column(Integer, primary_key=True)
+        ...     name =  Column('name_column', String(50))
+
+        >>> get_column(SomeClass.name) == (SomeClass, 'name')
+        True
+        >>> get_column(func.count(SomeClass.pk1).clauses.clauses[0]) == (SomeClass, 'pk1')
+        True
+        >>> get_column(aliased(SomeClass).name)
+        >>> get_column(SomeClass.__table__.c.pk1)
+        >>> get_column('foo')
+    """
+    from sqlalchemy.orm.exc import UnmappedColumnError
+
+    if hasattr(expression, "__clause_element__"):
+        expression = expression.__clause_element__()
+
+    mapper = getattr(expression, "_annotations", {}).get("parentmapper")
+    if mapper is None:
+        return None
+
+    try:
+        prop = mapper.get_property_by_column(expression)
+    except UnmappedColumnError:
+        return None
+
+    return mapper.class_, prop.key
+
+
+class AggregateColumn(object):
+    """
+    Single column of aggregate query result rows
+
+    Values of the column attribute ``key`` are reduced over all rows
+    of a group where ``None`` values are ignored as they are in SQL.
+    Without ``key``, as in ``count(*)``, rows themselves are aggregated.
+
+    For example::
+
+        >>> column = AggregateColumn('sum', 'value')
+        >>> state = column.start()
+        >>> for i in [1, None, 2]:
+        ...     state = column.step(state, i)
+        >>> column.finish(state)
+        3
+        >>> column.finish(column.start())
+
+        >>> column = AggregateColumn('avg', 'value')
+        >>> column.finish(column.step(column.step(column.start(), 1), 2))
+        1.5
+        >>> column.finish(column.start())
+    """
+
+    __slots__ = ["name", "key"]
+
+    # function name: (initial state, reducer, finalizer)
+    functions = {
+        "count": (0, lambda s, v: s + 1, None),
+        "sum": (None, lambda s, v: v if s is None else s + v, None),
+        "min": (None, lambda s, v: v if s is None or v < s else s, None),
+        "max": (None, lambda s, v: v if s is None or v > s else s, None),
+        "avg": (
+            (0, 0),
+            lambda s, v: (s[0] + v, s[1] + 1),
+            lambda s: float(s[0]) / s[1] if s[1] else None,
+        ),
+    }
+
+    def __init__(self, name, key=None):
+        self.name = name
+        self.key = key
+
+    def start(self):
+        return self.functions[self.name][0]
+
+    def step(self, state, value):
+        if value is None:
+            return state
+        return self.functions[self.name][1](state, value)
+
+    def finish(self, state):
+        finalizer = self.functions[self.name][2]
+        return finalizer(state) if finalizer else state
+
+
+class ValueColumn(object):
+    """
+    Single non-aggregated column of aggregate query result rows
+
+    Value is taken from the first row of each group.
+    """
+
+    __slots__ = ["key"]
+
+    def __init__(self, key):
+        self.key = key
+
+    def start(self):
+        return _MISSING
+
+    def step(self, state, value):
+        return value if state is _MISSING else state
+
+    def finish(self, state):
+        return None if state is _MISSING else state
+
+
+class ConstantColumn(object):
+    """
+    Single column of aggregate query result rows with constant value
+    such as value of :class:`ExistsResult`
+    """
+
+    __slots__ = ["value"]
+
+    key = None
+
+    def __init__(self, value):
+        self.value = value
+
+    def start(self):
+        return self.value
+
+    def step(self, state, value):
+        return state
+
+    def finish(self, state):
+        return state
+
+
+class AggregateQuery(object):
+    """
+    Aggregate query parsed from query calls
+
+    Columns and ``group_by`` refer to attributes of the queried model
+    by their names. Use :meth:`from_calls` to parse query calls.
+    """
+
+    def __init__(self, model, columns, group_by):
+        self.model = model
+        self.columns = columns
+        self.group_by = group_by
+
+    @classmethod
+    def from_calls(cls, calls):
+        """
+        Parse aggregate query from query calls
+
+        Returns ``None`` when query is not an aggregate query which can be
+        evaluated. That is when it neither selects aggregate functions
+        nor has ``group_by``, or when it selects anything other than
+        columns of a single model.
+
+        For example::
+
+            >>> from sqlalchemy import Column, Integer, String, func
+            >>> from sqlalchemy.ext.declarative import declarative_base
+
+            >>> Base = declarative_base()
+
+            >>> class SomeClass(Base):
+            ...     __tablename__ = 'some_table'
+            ...     pk1 = Column(Integer, primary_key=True)
+            ...     name =  Column(String(50))
+
+            >>> query = AggregateQuery.from_calls([
+            ...     ('query', (SomeClass.name, func.count(SomeClass.pk1)), {}),
+            ...     ('group_by', (SomeClass.name,), {}),
+            ... ])
+            >>> query.model is SomeClass, [i.key for i in query.columns], query.group_by
+            (True, ['name', 'pk1'], ['name'])
+            >>> AggregateQuery.from_calls([('query', (ExistsResult(True),), {})]).model
+            >>> AggregateQuery.from_calls([('query', (func.count(),), {})])
+
+            >>> AggregateQuery.from_calls([('query', (SomeClass.name,), {})])
+            >>> AggregateQuery.from_calls([('query', (SomeClass, func.count()), {})])
+            >>> AggregateQuery.from_calls([('query', (func.foo(SomeClass.pk1),), {})])
+            >>> AggregateQuery.from_calls([('query', (func.count(func.sum(SomeClass.pk1)),), {})])
+            >>> AggregateQuery.from_calls([('query', (func.count(SomeClass.pk1),), {}), ('group_by', ('foo',), {})])
+            >>> AggregateQuery.from_calls([('query', (func.max(SomeClass.pk1, 1),), {})])
+            >>> AggregateQuery.from_calls([('filter', (), {})])
+        """
+        from sqlalchemy.sql.elements import BindParameter, Label
+        from sqlalchemy.sql.functions import Function
+
+        expressions = [
+            j
+            for name, args, _ in calls
+            if name in ("query", "add_columns")
+            for j in args
+        ]
+        group_by = [
+            j for name, args, _ in calls if name == "group_by" for j in args
+        ]
+        is_aggregate = bool(group_by)
+        models = set()
+
+        def column_key(expression):
+            column = get_column(expression)
+            if column is None:
+                raise ValueError(expression)
+            models.add(column[0])
+            return column[1]
+
+        columns = []
+        try:
+            for expression in expressions:
+                if isinstance(expression, Label):
+                    expression = expression.element
+
+                if isinstance(expression, ExistsResult):
+                    is_aggregate = True
+                    columns.append(ConstantColumn(expression.exists))
+
+                elif isinstance(expression, Function):
+                    is_aggregate = True
+                    if expression.name not in AggregateColumn.functions:
+                        raise ValueError(expression)
+                    args = expression.clauses.clauses
+                    if len(args) != 1:
+                        raise ValueError(expression)
+                    # count(*) counts rows themselves
+                    if isinstance(args[0], BindParameter) or getattr(
+                        args[0], "is_literal", False
+                    ):
+                        key = None
+                    else:
+                        key = column_key(args[0])
+                    columns.append(AggregateColumn(expression.name, key))
+
+                else:
+                    columns.append(ValueColumn(column_key(expression)))
+
+            group_by = [column_key(i) for i in group_by]
+
+        except ValueError:
+            return None
+
+        if not is_aggregate or len(models) > 1:
+            return None
+        # rows can only be found for columns of a model
+        if not models and not all(
+            isinstance(i, ConstantColumn) for i in columns
+        ):
+            return None
+
+        return cls(models.pop() if models else None, columns, group_by)
+
+    def source_calls(self, calls):
+        """
+        Get query calls which select rows aggregated by this query
+        """
+        return [("query", (self.model,), {})] + [
+            i for i in calls if i[0] not in ("query", "add_columns", "group_by")
+        ]
+
+    def evaluate(self, rows):
+        """
+        Evaluate aggregate query over given rows in a single pass
+
+        Rows of :class:`~alchemy_mock.compact.CompactRows` are
+        aggregated over their columns without building any instances.
+
+        For example::
+
+            >>> from sqlalchemy import Column, Integer, String, func
+            >>> from sqlalchemy.ext.declarative import declarative_base
+
+            >>> Base = declarative_base()
+
+            >>> class SomeClass(Base):
+            ...     __tablename__ = 'some_table'
+            ...     pk1 = Column(Integer, primary_key=True)
+            ...     name =  Column(String(50))
+
+            >>> rows = CompactRows(SomeClass, pk1=[1, 2, 3], name=['a', 'b', 'a'])
+            >>> query = AggregateQuery.from_calls([
+            ...     ('query', (SomeClass.name, func.min(SomeClass.pk1), ExistsResult(True)), {}),
+            ...     ('group_by', (SomeClass.name,), {}),
+            ... ])
+            >>> query.evaluate(rows), len(rows.instances)
+            ([('a', 1, True), ('b', 2, True)], 0)
+        """
+        columns = self.columns
+        keys = sorted(
+            set(i.key for i in columns if i.key is not None)
+            | set(self.group_by)
+        )
+        positions = {k: i for i, k in enumerate(keys)}
+        group_by = [positions[i] for i in self.group_by]
+        # count(*) aggregates rows which are never None
+        values = [positions.get(i.key, len(keys)) for i in columns]
+
+        if isinstance(rows, (CompactRows, FilteredRows)):
+            records = rows.values(keys)
+        else:
+            records = (tuple(getattr(row, k) for k in keys) for row in rows)
+
+        get_key = itemgetter(*group_by) if group_by else _empty_key
+        steps = list(enumerate(zip([i.step for i in columns], values)))
+
+        groups = collections.OrderedDict()
+        if not group_by:
+            # aggregates without grouping always produce single row
+            groups[()] = [i.start() for i in columns]
+
+        for record in records:
+            record += (True,)
+            key = get_key(record)
+            states = groups.get(key)
+            if states is None:
+                states = groups[key] = [i.start() for i in columns]
+            for i, (step, value) in steps:
+                states[i] = step(states[i], record[value])
+
+        return [
+            tuple(column.finish(state) for column, state in zip(columns, i))
+            for i in groups.values()
+        ]
+
+
+def _empty_key(record):
+    return ()
@@ -0,0 +1,804 @@
+# -*- coding: utf-8 -*-
+"""
+Column-oriented compact storage of mock data rows
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import collections
+import itertools
+import weakref
+from array import array
+
+import six
+
+from .utils import build_identity_map, copy_and_update
+
+
+def _int_typecode():
+    # 64 bit signed integers are "q" however Python 2 only has "l"
+    try:
+        array("q")
+    except ValueError:  # pragma: no cover
+        return "l"
+    return "q"
+
+
+INT_TYPECODE = _int_typecode()
+
+# key of row handle of built instance in info of its instance state
+ROW_INFO_KEY = "alchemy_mock.row"
+
+_tracked_models = weakref.WeakSet()
+
+
+def track_changes(model):
+    """
+    Listen to changes of column attributes of given model so that
+    changed instances built from :class:`CompactRows` are kept
+
+    Returns whether changes can be tracked which is only
+    the case for mapped models.
+
+    For example::
+
+        >>> from sqlalchemy import Column, Integer
+        >>> from sqlalchemy.ext.declarative import declarative_base
+
+        >>> Base = declarative_base()
+
+        >>> class SomeClass(Base):
+        ...     __tablename__ = 'some_table'
+        ...     pk1 = Column(Integer, primary_key=True)
+
+        >>> track_changes(SomeClass), track_changes(SomeClass), track_changes(int)
+        (True, True, False)
+    """
+    from sqlalchemy import event, inspect
+
+    if model in _tracked_models:
+        return True
+
+    mapper = inspect(model, raiseerr=False)
+    if mapper is None:
+        return False
+
+    for prop in mapper.column_attrs:
+        event.listen(prop.class_attribute, "set", _on_set, propagate=True)
+    _tracked_models.add(model)
+    return True
+
+
+def _on_set(target, value, oldvalue, initiator):
+    handle = _row_handle(target)
+    if handle is not None:
+        handle.rows.mark_changed(handle.index, target)
+
+
+def _row_handle(instance, remove=False):
+    from sqlalchemy.orm.attributes import instance_state
+
+    info = instance_state(instance).info
+    if remove:
+        return info.pop(ROW_INFO_KEY, None)
+    return info.get(ROW_INFO_KEY)
+
+
+def compact_column(values):
+    """
+    Store column values in the most compact sequence
+
+    Integers and floats are stored in typed arrays and all other
+    values are stored in a tuple.
+
+    For example::
+
+        >>> compact_column([1, 2, 3]).typecode == INT_TYPECODE
+        True
+        >>> compact_column(iter([1.5, 2.5])).typecode
+        'd'
+        >>> compact_column([True, False])
+        (True, False)
+        >>> compact_column([1, None])
+        (1, None)
+        >>> compact_column([2 ** 64])
+        (18446744073709551616,)
+    """
+    values = tuple(values)
+    types = set(type(i) for i in values)
+
+    for typecode, column_types in (
+        (INT_TYPECODE, set(six.integer_types)),
+        ("d", {float}),
+    ):
+        if types and types <= column_types:
+            try:
+                return array(typecode, values)
+            except OverflowError:
+                break
+
+    return values
+
+
+class RowHandle(object):
+    """
+    Lightweight handle of a single row of :class:`CompactRows`
+    which gives access to column values without building ORM instance
+    """
+
+    __slots__ = ["rows", "index"]
+
+    def __init__(self, rows, index):
+        self.rows = rows
+        self.index = index
+
+    def __getattr__(self, name):
+        return self.rows.value(self.index, name)
+
+    @property
+    def identity(self):
+        """
+        Identity key of the row as ``(model, primary key)``
+        """
+        return self.rows.model, self.rows.primary_key(self.index)
+
+    @property
+    def instance(self):
+        """
+        ORM instance of the row
+        """
+        return self.rows[self.index]
+
+
+class CompactRows(object):
+    """
+    Column-oriented storage of model rows which can be used in place
+    of result list in mock data
+
+    Rows are stored per column in typed arrays or tuples and ORM instances
+    are only built for rows which are actually returned. Built instances
+    are cached for as long as they are used so that same row is always
+    the same instance. Changed instances of mapped models are kept
+    until their changes are written back to the columns
+    by session flush or commit.
+
+    For example::
+
+        >>> from sqlalchemy import Column, Integer, String
+        >>> from sqlalchemy.ext.declarative import declarative_base
+        >>> from alchemy_mock.compat import mock
+        >>> from alchemy_mock.mocking import UnifiedAlchemyMagicMock
+
+        >>> Base = declarative_base()
+
+        >>> class SomeClass(Base):
+        ...     __tablename__ = 'some_table'
+        ...     pk1 = Column(Integer, primary_key=True)
+        ...     name =  Column(String(50))
+        ...     def __repr__(self):
+        ...         return '{}:{}'.format(self.pk1, self.name)
+
+        >>> rows = CompactRows(
+        ...     SomeClass,
+        ...     pk1=range(100000),
+        ...     name=['row'] * 100000,
+        ... )
+        >>> s = UnifiedAlchemyMagicMock(data=[
+        ...     ([mock.call.query(SomeClass)], rows),
+        ... ])
+        >>> s.query(SomeClass).count()
+        100000
+        >>> s.query(SomeClass).first()
+        0:row
+        >>> s.query(SomeClass).get((5,))
+        5:row
+        >>> s.query(SomeClass).get((5,)) is s.query(SomeClass).get((5,))
+        True
+        >>> len(rows.instances)
+        0
+
+    Rows can be mutated via session as any other result-set::
+
+        >>> one = s.query(SomeClass).get((1,))
+        >>> s.merge(SomeClass(pk1=1, name='one'))
+        1:one
+        >>> s.delete(s.query(SomeClass).get((0,)))
+        >>> s.add(SomeClass(pk1=100000, name='last'))
+        >>> del one
+        >>> s.query(SomeClass).first()
+        1:one
+        >>> s.query(SomeClass).count()
+        100000
+        >>> s.rollback()
+        >>> s.query(SomeClass).first()
+        0:row
+        >>> s.query(SomeClass).get((1,))
+        1:row
+        >>> s.query(SomeClass).get((100000,))
+
+    Hence changes of instances are kept even once they are not used::
+
+        >>> from sqlalchemy import func
+        >>> small = CompactRows(SomeClass, pk1=[1, 2, 3], name=['one', 'two', 'x'])
+        >>> s = UnifiedAlchemyMagicMock(data=[
+        ...     ([mock.call.query(SomeClass)], small),
+        ... ])
+        >>> for i in s.query(SomeClass).filter(SomeClass.pk1 < 3).all()[:2]:
+        ...     i.name = 'changed'
+        >>> del i
+        >>> len(small.instances), len(small.changed)
+        (2, 2)
+        >>> s.query(SomeClass.name, func.count(SomeClass.pk1)).group_by(SomeClass.name).all()
+        [('changed', 2), ('x', 1)]
+        >>> s.commit()
+        >>> list(small.columns['name']), len(small.changed)
+        (['changed', 'changed', 'x'], 0)
+        >>> s.query(SomeClass).get((2,)).name = 'two'
+        >>> s.flush()
+        >>> s.rollback()
+        >>> s.query(SomeClass).all()
+        [1:changed, 2:changed, 3:x]
+
+    Rows can be indexed and sliced as a list::
+
+        >>> rows[-1], rows[1:3]
+        (99999:row, [1:row, 2:row])
+        >>> rows[100000]
+        Traceback (most recent call last):
+        ...
+        IndexError: row index out of range
+
+    Values which do not fit into typed arrays are stored in lists::
+
+        >>> rows = CompactRows(SomeClass, pk1=[1], name=['one'])
+        >>> rows.insert(0, SomeClass(name='none'))
+        >>> rows.columns['pk1'], rows[0].name
+        ([None, 1], 'none')
+
+        >>> CompactRows(SomeClass, pk1=[1, 2], name=['one'])
+        Traceback (most recent call last):
+        ...
+        ValueError: All columns must have the same length
+    """
+
+    def __init__(self, model, **columns):
+        self.model = model
+        self.columns = collections.OrderedDict(
+            (k, compact_column(v)) for k, v in sorted(columns.items())
+        )
+
+        lengths = set(len(i) for i in self.columns.values())
+        if len(lengths) > 1:
+            raise ValueError("All columns must have the same length")
+
+        self._length = lengths.pop() if lengths else 0
+        # built instances are cached by row position for as long as
+        # they are used and changed ones are kept until they are released
+        # while instances added to or mutated via store
+        # are pinned so that their state is never lost
+        self.instances = weakref.WeakValueDictionary()
+        self.changed = {}
+        self.pinned = {}
+        self._primary_keys = None
+        self._tracked = None
+
+    @classmethod
+    def from_instances(cls, model, instances):
+        """
+        Create compact rows from column values of given instances
+
+        For example::
+
+            >>> from sqlalchemy import Column, Integer
+            >>> from sqlalchemy.ext.declarative import declarative_base
+
+            >>> Base = declarative_base()
+
+            >>> class SomeClass(Base):
+            ...     __tablename__ = 'some_table'
+            ...     pk1 = Column(Integer, primary_key=True)
+            ...     pk2 = Column(Integer, primary_key=True)
+
+            >>> rows = CompactRows.from_instances(
+            ...     SomeClass, [SomeClass(pk1=1, pk2=2), SomeClass(pk1=3, pk2=4)]
+            ... )
+            >>> rows
+            CompactRows(SomeClass, 2 rows)
+            >>> list(rows.columns['pk2'])
+            [2, 4]
+        """
+        instances = list(instances)
+        return cls(
+            model,
+            **{
+                k: [getattr(i, k) for i in instances]
+                for k in cls._column_keys(model)
+            }
+        )
+
+    @staticmethod
+    def _column_keys(model):
+        from sqlalchemy import inspect
+
+        return [i.key for i in inspect(model).column_attrs]
+
+    def __repr__(self):
+        return "CompactRows({}, {} rows)".format(
+            self.model.__name__, self._length
+        )
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for i in six.moves.range(self._length):
+            yield self[i]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in six.moves.range(*index.indices(len(self)))]
+
+        from sqlalchemy.orm.attributes import instance_state
+
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("row index out of range")
+
+        instance = self.pinned.get(index)
+        if instance is None:
+            instance = self.instances.get(index)
+        if instance is None:
+            instance = self.model(
+                **{k: v[index] for k, v in self.columns.items()}
+            )
+            self.instances[index] = instance
+            if self._tracks_changes():
+                # set after building so that only later changes are tracked
+                instance_state(instance).info[ROW_INFO_KEY] = RowHandle(
+                    self, index
+                )
+        if not self._tracked and index not in self.pinned:
+            # changes cannot be tracked hence instance might be changed
+            self.changed[index] = instance
+        return instance
+
+    def _tracks_changes(self):
+        if self._tracked is None:
+            self._tracked = track_changes(self.model)
+        return self._tracked
+
+    def mark_changed(self, index, instance):
+        """
+        Keep changed built instance until it is released
+        """
+        if index not in self.pinned:
+            self.changed[index] = instance
+
+    def handles(self):
+        """
+        Iterate over :class:`RowHandle` of all rows
+        """
+        for i in six.moves.range(self._length):
+            yield RowHandle(self, i)
+
+    def values(self, names):
+        """
+        Iterate over tuples of values of given columns of all rows
+
+        For example::
+
+            >>> class Row(object):
+            ...     def __init__(self, **kwargs):
+            ...         vars(self).update(kwargs)
+
+            >>> rows = CompactRows(Row, a=[1, 2], b=['x', 'y'])
+            >>> rows.pin(rows[1])
+            >>> rows[1].b = 'z'
+            >>> list(rows.values(['b', 'a']))
+            [('x', 1), ('z', 2)]
+        """
+        records = six.moves.zip(*[self.columns[k] for k in names])
+        built = self._built()
+        if not built:
+            return records
+        return (
+            tuple(getattr(built[i], k) for k in names) if i in built else record
+            for i, record in enumerate(records)
+        )
+
+    def value(self, index, name):
+        """
+        Get value of a single column of given row
+        """
+        instance = self.pinned.get(index, self.changed.get(index))
+        if instance is not None:
+            return getattr(instance, name)
+        return self.columns[name][index]
+
+    def _built(self):
+        # changed instances are not yet written back to columns
+        if not self.changed:
+            return self.pinned
+        built = dict(self.changed)
+        built.update(self.pinned)
+        return built
+
+    @property
+    def primary_key_names(self):
+        """
+        Names of primary key columns of the model
+        """
+        from sqlalchemy import inspect
+
+        mapper = inspect(self.model)
+        return [
+            mapper.get_property_by_column(i).key for i in mapper.primary_key
+        ]
+
+    def primary_key(self, index):
+        """
+        Get primary key tuple of given row
+        """
+        return tuple(self.value(index, k) for k in self.primary_key_names)
+
+    def get(self, ident):
+        """
+        Get instance by its primary key tuple
+        """
+        index = self.locate(ident)
+        return self[index] if index is not None else None
+
+    def locate(self, ident):
+        """
+        Get position of row with given primary key tuple
+        or ``None`` when there is no such row
+
+        Rows are indexed by primary key on first use.
+        """
+        if self._primary_keys is None:
+            columns = [self.columns[k] for k in self.primary_key_names]
+            self._primary_keys = {
+                k: i for i, k in enumerate(six.moves.zip(*columns))
+            }
+            # pinned instances might have been changed
+            for i in self.pinned:
+                self._primary_keys[self.primary_key(i)] = i
+
+        return self._primary_keys.get(ident)
+
+    def index(self, instance):
+        """
+        Find position of given already built instance
+        """
+        for cache in (self.pinned, self.instances):
+            for index, i in list(cache.items()):
+                if i is instance:
+                    return index
+        raise ValueError("{!r} is not in {!r}".format(instance, self))
+
+    def pin(self, instance):
+        """
+        Keep already built instance so that its state is never lost
+        """
+        index = self.index(instance)
+        self.changed.pop(index, None)
+        self.pinned[index] = instance
+
+    def changes(self):
+        """
+        Iterate over ``(index, column, value)`` of all column values
+        which differ in changed instances which are not pinned
+
+        For example::
+
+            >>> class Row(object):
+            ...     def __init__(self, **kwargs):
+            ...         vars(self).update(kwargs)
+
+            >>> rows = CompactRows(Row, a=[1, 2], b=[3, 4])
+            >>> rows[0].b = 5
+            >>> rows.pin(rows[1])
+            >>> rows[1].a = 6
+            >>> list(rows.changes())
+            [(0, 'b', 5)]
+        """
+        for index, instance in list(self.changed.items()):
+            for key, column in self.columns.items():
+                value = getattr(instance, key)
+                if value != column[index]:
+                    yield index, key, value
+
+    def set_value(self, index, key, value):
+        """
+        Set value of a single column of given row
+
+        For example::
+
+            >>> rows = CompactRows(int, a=[1, 2])
+            >>> rows.set_value(0, 'a', 3)
+            >>> rows.set_value(1, 'a', None)
+            >>> rows.columns['a']
+            [3, None]
+        """
+        try:
+            self._writable(key)[index] = value
+        except (TypeError, OverflowError):
+            # value does not fit into typed array
+            self.columns[key] = list(self.columns[key])
+            self.columns[key][index] = value
+        self._primary_keys = None
+
+    def release(self):
+        """
+        Stop keeping changed instances once their changes are written back
+        """
+        self.changed.clear()
+
+    def expire(self):
+        """
+        Forget all built instances which are not pinned
+        so that they are built again from column values
+        """
+        for instance in list(self.instances.values()):
+            self._untrack(instance)
+        self.changed.clear()
+        self.instances.clear()
+
+    def insert(self, index, instance):
+        """
+        Insert instance before given position
+        """
+        for k in self.columns:
+            value = getattr(instance, k)
+            try:
+                self._writable(k).insert(index, value)
+            except (TypeError, OverflowError):
+                # value does not fit into typed array
+                self.columns[k] = list(self.columns[k])
+                self.columns[k].insert(index, value)
+
+        self._shift(index, 1)
+        self.pinned[index] = instance
+
+    def pop(self, index):
+        """
+        Remove and return instance at given position
+        """
+        instance = self[index]
+
+        for k in self.columns:
+            self._writable(k).pop(index)
+
+        self.pinned.pop(index, None)
+        self.changed.pop(index, None)
+        self.instances.pop(index, None)
+        self._untrack(instance)
+        self._shift(index, -1)
+        return instance
+
+    def _untrack(self, instance):
+        # instance no longer corresponds to its row
+        if self._tracked:
+            _row_handle(instance, remove=True)
+
+    def _writable(self, key):
+        if isinstance(self.columns[key], tuple):
+            self.columns[key] = list(self.columns[key])
+        return self.columns[key]
+
+    def _shift(self, index, offset):
+        self._length += offset
+        self._primary_keys = None
+
+        for cache in (self.pinned, self.changed, self.instances):
+            shifted = [(k, v) for k, v in list(cache.items()) if k >= index]
+            for k, _ in shifted:
+                del cache[k]
+            for k, v in shifted:
+                cache[k + offset] = v
+
+        if self._tracked:
+            for k, v in list(self.instances.items()):
+                handle = _row_handle(v)
+                if handle is not None:
+                    handle.index = k
+
+
+class FilteredRows(object):
+    """
+    Lazy view of :class:`CompactRows` without some of its instances,
+    with some of its instances replaced and with extra instances appended
+
+    Excluded and replaced instances are looked up by their row positions
+    hence only instances of returned rows are built. Optional ``loader``
+    is called with every instance of the rows once it is returned.
+
+    For example::
+
+        >>> from sqlalchemy import Column, Integer
+        >>> from sqlalchemy.ext.declarative import declarative_base
+
+        >>> Base = declarative_base()
+
+        >>> class SomeClass(Base):
+        ...     __tablename__ = 'some_table'
+        ...     pk1 = Column(Integer, primary_key=True)
+        ...     def __repr__(self):
+        ...         return str(self.pk1)
+
+        >>> rows = CompactRows(SomeClass, pk1=range(1000))
+        >>> view = FilteredRows(
+        ...     rows, [rows[0], rows[500], SomeClass(pk1=1)], [SomeClass(pk1=1000)]
+        ... )
+        >>> len(view), view[0], view[500], view[-1], len(rows.instances)
+        (999, 1, 502, 1000, 2)
+        >>> view[999]
+        Traceback (most recent call last):
+        ...
+        IndexError: row index out of range
+        >>> view.get((500,)), view.get((501,)), view.get((1000,)), view.get((1001,))
+        (None, 501, 1000, None)
+        >>> list(view.values(['pk1']))[-2:]
+        [(999,), (1000,)]
+
+        >>> view = FilteredRows(rows, replaced=[(rows[1], SomeClass(pk1=-1))])
+        >>> list(view)[:3], view[1], view.get((1,)), list(view.values(['pk1']))[:2]
+        ([0, -1, 2], -1, -1, [(0,), (-1,)])
+
+        >>> view = FilteredRows(rows, loader=print).exclude([rows[0]], [SomeClass(pk1=-2)])
+        >>> view[0], view[-1]
+        1
+        (1, -2)
+    """
+
+    def __init__(self, rows, excluded=(), extra=(), replaced=(), loader=None):
+        self.rows = rows
+        self.excluded = set(self._position(i) for i in excluded)
+        self.excluded.discard(None)
+        self.replaced = {self._position(i): j for i, j in replaced}
+        self.replaced.pop(None, None)
+        self.extra = list(extra)
+        self.loader = loader
+
+    def exclude(self, excluded=(), extra=(), replaced=()):
+        """
+        Get view of the same rows which additionally excludes,
+        appends and replaces given instances
+        """
+        excluded = list(excluded)
+        ids = set(map(id, excluded))
+        view = FilteredRows(
+            self.rows,
+            excluded,
+            [i for i in self.extra if id(i) not in ids] + list(extra),
+            replaced,
+            self.loader,
+        )
+        view.excluded.update(self.excluded)
+        view.replaced = copy_and_update(self.replaced, view.replaced)
+        return view
+
+    def _position(self, instance):
+        try:
+            return self.rows.index(instance)
+        except ValueError:
+            # instance is not part of these rows
+            return None
+
+    def _row(self, index):
+        if index in self.replaced:
+            return self.replaced[index]
+        instance = self.rows[index]
+        if self.loader is not None:
+            self.loader(instance)
+        return instance
+
+    def __len__(self):
+        return len(self.rows) - len(self.excluded) + len(self.extra)
+
+    def __iter__(self):
+        for i in six.moves.range(len(self.rows)):
+            if i not in self.excluded:
+                yield self._row(i)
+        for i in self.extra:
+            yield i
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("row index out of range")
+
+        kept = len(self.rows) - len(self.excluded)
+        if index >= kept:
+            return self.extra[index - kept]
+        # skip over excluded rows preceding the position
+        for i in sorted(self.excluded):
+            if i > index:
+                break
+            index += 1
+        return self._row(index)
+
+    def values(self, names):
+        """
+        Iterate over tuples of values of given columns of all rows
+        """
+        replaced = self.replaced
+        records = (
+            tuple(getattr(replaced[i], k) for k in names)
+            if i in replaced
+            else record
+            for i, record in enumerate(self.rows.values(names))
+            if i not in self.excluded
+        )
+        extra = (tuple(getattr(i, k) for k in names) for i in self.extra)
+        return itertools.chain(records, extra)
+
+    def get(self, ident):
+        """
+        Get instance by its primary key tuple
+        """
+        instance = build_identity_map(self.extra).get(ident)
+        if instance is not None:
+            return instance
+        index = self.rows.locate(ident)
+        if index is None or index in self.excluded:
+            return None
+        return self._row(index)
+
+
+def get_identity(results, ident):
+    """
+    Get instance by its primary key tuple from any of given result-sets
+
+    Similar to identity map of all result-sets chained together,
+    later result-sets take precedence.
+
+    For example::
+
+        >>> from sqlalchemy import Column, Integer
+        >>> from sqlalchemy.ext.declarative import declarative_base
+
+        >>> Base = declarative_base()
+
+        >>> class SomeClass(Base):
+        ...     __tablename__ = 'some_table'
+        ...     pk1 = Column(Integer, primary_key=True)
+        ...     def __repr__(self):
+        ...         return str(self.pk1)
+
+        >>> results = [
+        ...     [SomeClass(pk1=1)],
+        ...     CompactRows(SomeClass, pk1=[2]),
+        ...     [SomeClass(pk1=1)],
+        ... ]
+        >>> get_identity(results, (1,)) is results[2][0]
+        True
+        >>> get_identity(results, (2,)), get_identity(results, (3,))
+        (2, None)
+    """
+    for result in reversed(results):
+        if isinstance(result, (CompactRows, FilteredRows)):
+            instance = result.get(ident)
+        else:
+            instance = build_identity_map(result).get(ident)
+        if instance is not None:
+            return instance
+    return None
+
+
+def is_instance(item, model):
+    """
+    Check whether given row handle or instance is of given model
+    """
+    if isinstance(item, RowHandle):
+        return issubclass(item.rows.model, model)
+    return isinstance(item, model)
+
+
+def materialize(item):
+    """
+    Get ORM instance of given row handle or instance
+    """
+    if isinstance(item, RowHandle):
+        return item.instance
+    return item
@@ -1,28 +1,225 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
 import collections
+import importlib
+import sys
 
 import six
-from sqlalchemy import func
-from sqlalchemy.sql.expression import column, or_
-
-from .compat import mock
-from .utils import match_type
-
-
-ALCHEMY_UNARY_EXPRESSION_TYPE = type(column("").asc())
-ALCHEMY_BINARY_EXPRESSION_TYPE = type(column("") == "")
-ALCHEMY_BOOLEAN_CLAUSE_LIST = type(or_(column("") == "", column("").is_(None)))
-ALCHEMY_FUNC_TYPE = type(func.dummy(column("")))
-ALCHEMY_LABEL_TYPE = type(column("").label(""))
-ALCHEMY_TYPES = (
-    ALCHEMY_UNARY_EXPRESSION_TYPE,
-    ALCHEMY_BINARY_EXPRESSION_TYPE,
-    ALCHEMY_BOOLEAN_CLAUSE_LIST,
-    ALCHEMY_FUNC_TYPE,
-    ALCHEMY_LABEL_TYPE,
+
+from .compat import Mapping, mock
+from .utils import WeakIdentityCache, match_type
+
+
+# SQLAlchemy types are resolved lazily from their defining classes
+# since importing SQLAlchemy is by far the most expensive part
+# of importing alchemy_mock
+LAZY_ALCHEMY_TYPES = collections.OrderedDict(
+    [
+        (
+            "ALCHEMY_UNARY_EXPRESSION_TYPE",
+            "sqlalchemy.sql.elements.UnaryExpression",
+        ),
+        (
+            "ALCHEMY_BINARY_EXPRESSION_TYPE",
+            "sqlalchemy.sql.elements.BinaryExpression",
+        ),
+        (
+            "ALCHEMY_BOOLEAN_CLAUSE_LIST",
+            "sqlalchemy.sql.elements.BooleanClauseList",
+        ),
+        (
+            "ALCHEMY_FUNC_TYPE",
+            "sqlalchemy.sql.functions.Function",
+        ),
+        (
+            "ALCHEMY_LABEL_TYPE",
+            "sqlalchemy.sql.elements.Label",
+        ),
+    ]
 )
 
+_alchemy_types = None
+_positional_dialect = None
+_compile_cache = WeakIdentityCache()
+_structure_cache = WeakIdentityCache()
+_repr_cache = WeakIdentityCache()
+
+
+def get_alchemy_type(name):
+    """
+    Get SQLAlchemy type by its ``ALCHEMY_*`` name
+
+    For example::
+
+        >>> get_alchemy_type('ALCHEMY_LABEL_TYPE')
+        <class 'sqlalchemy.sql.elements.Label'>
+    """
+    module, _, attr = LAZY_ALCHEMY_TYPES[name].rpartition(".")
+    return getattr(importlib.import_module(module), attr)
+
+
+def get_alchemy_types():
+    """
+    Get tuple of all SQLAlchemy expression types ``ExpressionMatcher`` can compare
+
+    Types are resolved on first use and then cached.
+
+    For example::
+
+        >>> from sqlalchemy.sql.expression import column
+        >>> isinstance(column('column') == 5, get_alchemy_types())
+        True
+    """
+    global _alchemy_types
+    if _alchemy_types is None:
+        _alchemy_types = tuple(get_alchemy_type(i) for i in LAZY_ALCHEMY_TYPES)
+    return _alchemy_types
+
+
+def __getattr__(name):
+    """
+    Lazily resolve ``ALCHEMY_*`` types as module attributes (PEP 562)
+
+    For example::
+
+        >>> from alchemy_mock.comparison import ALCHEMY_FUNC_TYPE, ALCHEMY_TYPES
+        >>> ALCHEMY_FUNC_TYPE
+        <class 'sqlalchemy.sql.functions.Function'>
+        >>> ALCHEMY_FUNC_TYPE in ALCHEMY_TYPES
+        True
+        >>> from alchemy_mock.comparison import ALCHEMY_FOO_TYPE
+        Traceback (most recent call last):
+        ...
+        ImportError: cannot import name 'ALCHEMY_FOO_TYPE'
+    """
+    if name == "ALCHEMY_TYPES":
+        return get_alchemy_types()
+    if name in LAZY_ALCHEMY_TYPES:
+        return get_alchemy_type(name)
+    raise AttributeError(
+        "module {!r} has no attribute {!r}".format(__name__, name)
+    )
+
+
+if sys.version_info < (3, 7):  # pragma: no cover
+    # module level __getattr__ is not supported hence types are resolved eagerly
+    ALCHEMY_TYPES = get_alchemy_types()
+    globals().update((i, get_alchemy_type(i)) for i in LAZY_ALCHEMY_TYPES)
+
+
+def compile_expression(expr):
+    """
+    Compile SQLAlchemy expression into its SQL text and params
+
+    Compiled results are cached per expression in a cache shared by all
+    comparisons and representations since compiling is relatively expensive.
+
+    For example::
+
+        >>> from sqlalchemy.sql.expression import column
+        >>> e = column('column') == 5
+        >>> compile_expression(e)
+        ('"column" = :column_1', {'column_1': 5})
+        >>> compile_expression(e) is compile_expression(e)
+        True
+    """
+    return _compile_cache.get(expr, _compile)
+
+
+def _compile(expr):
+    compiled = expr.compile()
+    return six.text_type(compiled), compiled.params
+
+
+def compile_structure(expr):
+    """
+    Compile SQLAlchemy expression into its SQL text with positional
+    placeholders and list of its bind parameters in the same order
+
+    Unlike :func:`compile_expression`, SQL text does not depend on
+    names of bind parameters hence it only describes structure
+    of the expression. Compiled results are cached per expression.
+
+    For example::
+
+        >>> from sqlalchemy import bindparam
+        >>> from sqlalchemy.sql.expression import column
+        >>> c = column('column')
+        >>> sql, binds = compile_structure(c == 5)
+        >>> sql, [b.effective_value for b in binds]
+        ('"column" = ?', [5])
+        >>> compile_structure(c == bindparam('foo'))[0] == sql
+        True
+    """
+    return _structure_cache.get(expr, _compile_structure)
+
+
+def _compile_structure(expr):
+    global _positional_dialect
+    if _positional_dialect is None:
+        from sqlalchemy.engine.default import StrCompileDialect
+
+        _positional_dialect = StrCompileDialect(paramstyle="qmark")
+
+    compiled = expr.compile(dialect=_positional_dialect)
+    return (
+        six.text_type(compiled),
+        [compiled.binds[i] for i in compiled.positiontup],
+    )
+
+
+def expression_key(value):
+    """
+    Get hashable key of given value such that values which
+    ``ExpressionMatcher`` considers equal have equal keys
+
+    Raises ``TypeError`` for values which cannot have a key
+    such as ``mock.ANY`` which matches anything or unhashable objects.
+
+    For example::
+
+        >>> from sqlalchemy.sql.expression import column
+        >>> c = column('column')
+        >>> expression_key(c == 5) == expression_key(c == 5)
+        True
+        >>> expression_key(c == 5) == expression_key(c == 6)
+        False
+        >>> expression_key([c == 5, {'foo': 'bar'}]) == expression_key([c == 5, {'foo': 'bar'}])
+        True
+        >>> expression_key(c.in_([1, 2])) == expression_key(c.in_([1, 2]))
+        True
+        >>> expression_key(1) == expression_key(True)
+        False
+        >>> expression_key(mock.ANY)
+        Traceback (most recent call last):
+        ...
+        TypeError: mock.ANY cannot have a key
+    """
+    if isinstance(value, get_alchemy_types()):
+        sql, params = compile_expression(value)
+        return type(value), sql, expression_key(params)
+
+    if isinstance(value, type(mock.ANY)):
+        raise TypeError("mock.ANY cannot have a key")
+
+    if isinstance(value, six.string_types):
+        return six.text_type, match_type(value, six.text_type)
+
+    if isinstance(value, (list, tuple)):
+        return type(value), tuple(expression_key(i) for i in value)
+
+    if isinstance(value, Mapping):
+        return (
+            type(value),
+            frozenset(
+                (expression_key(k), expression_key(v))
+                for k, v in value.items()
+            ),
+        )
+
+    hash(value)
+    return type(value), value
+
 
 class PrettyExpression(object):
     """
@@ -30,6 +227,7 @@ class PrettyExpression(object):
 
     For example::
 
+        >>> from sqlalchemy.sql.expression import column
         >>> c = column('column')
         >>> PrettyExpression(c == 5)
         BinaryExpression(sql='"column" = :column_1', params={'column_1': 5})
@@ -37,6 +235,13 @@ class PrettyExpression(object):
         10
         >>> PrettyExpression(PrettyExpression(15))
         15
+
+    Rendered representations are cached per expression
+    since compiling expressions is relatively expensive::
+
+        >>> e = c == 5
+        >>> repr(PrettyExpression(e)) is repr(PrettyExpression(e))
+        True
     """
 
     __slots__ = ["expr"]
@@ -47,15 +252,19 @@ class PrettyExpression(object):
         self.expr = e
 
     def __repr__(self):
-        if not isinstance(self.expr, ALCHEMY_TYPES):
+        if not isinstance(self.expr, get_alchemy_types()):
             return repr(self.expr)
 
-        compiled = self.expr.compile()
+        return _repr_cache.get(self.expr, self._render)
+
+    @staticmethod
+    def _render(expr):
+        sql, params = compile_expression(expr)
 
         return "{}(sql={!r}, params={!r})".format(
-            self.expr.__class__.__name__,
-            match_type(six.text_type(compiled).replace("\n", " "), str),
-            {match_type(k, str): v for k, v in compiled.params.items()},
+            expr.__class__.__name__,
+            match_type(sql.replace("\n", " "), str),
+            {match_type(k, str): v for k, v in params.items()},
         )
 
 
@@ -67,6 +276,8 @@ class ExpressionMatcher(PrettyExpression):
 
     For example::
 
+        >>> from sqlalchemy import func
+        >>> from sqlalchemy.sql.expression import column
         >>> c = column('column')
         >>> c2 = column('column2')
         >>> l1 = c.label('foo')
@@ -136,7 +347,7 @@ class ExpressionMatcher(PrettyExpression):
         if type(self.expr) is not type(other):
             return False
 
-        if not isinstance(self.expr, ALCHEMY_TYPES):
+        if not isinstance(self.expr, get_alchemy_types()):
 
             def _(v):
                 return type(self)(v)
@@ -147,7 +358,7 @@ class ExpressionMatcher(PrettyExpression):
                     for i, j in six.moves.zip_longest(self.expr, other)
                 )
 
-            elif isinstance(self.expr, collections.Mapping):
+            elif isinstance(self.expr, Mapping):
                 same_keys = self.expr.keys() == other.keys()
                 return same_keys and all(
                     _(self.expr[k]) == other[k] for k in self.expr.keys()
@@ -156,16 +367,7 @@ class ExpressionMatcher(PrettyExpression):
             else:
                 return self.expr is other or self.expr == other
 
-        expr_compiled = self.expr.compile()
-        other_compiled = other.compile()
-
-        if six.text_type(expr_compiled) != six.text_type(other_compiled):
-            return False
-
-        if expr_compiled.params != other_compiled.params:
-            return False
-
-        return True
+        return compile_expression(self.expr) == compile_expression(other)
 
     def __ne__(self, other):
         return not (self == other)
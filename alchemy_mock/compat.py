@@ -9,3 +9,8 @@ except ImportError:  # pragma: no cover
         import mock
     except ImportError:  # pragma: no cover
         from unittest import mock  # noqa # pragma: no cover
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # pragma: no cover
+    from collections import Mapping  # noqa
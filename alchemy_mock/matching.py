@@ -0,0 +1,478 @@
+# -*- coding: utf-8 -*-
+"""
+Precompiled matching of data spec criteria
+
+Criteria in data specs can be templates which instead of exact values have:
+
+* ``bindparam('name')`` placeholders without a value which match any value
+  and capture it under given name
+* ``mock.ANY`` values which match any value without capturing it
+
+Placeholders can be used either directly as call arguments
+(e.g. ``filter_by(name=bindparam('name'))``) or as values within
+SQLAlchemy expressions (e.g. ``filter(User.id == bindparam('id'))``).
+When result in the data spec is callable, it is called with all captured
+values as keyword arguments to produce the result-set.
+
+All criteria are compiled once into :class:`DataIndex` which indexes
+entries by structural signatures of their calls so that only entries
+which can possibly match a query are ever compared with it.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+from collections import Counter, defaultdict
+from itertools import chain
+
+import six
+
+from .comparison import ExpressionMatcher, compile_structure, get_alchemy_types
+from .compat import mock
+from .utils import match_type
+
+
+CAPTURE = "capture"
+ANY = "any"
+VALUE = "value"
+
+
+def is_placeholder(value):
+    """
+    Check whether value is ``bindparam()`` placeholder without a value
+
+    For example::
+
+        >>> from sqlalchemy import bindparam
+        >>> is_placeholder(bindparam('foo'))
+        True
+        >>> is_placeholder(bindparam('foo', 5))
+        False
+        >>> is_placeholder('foo')
+        False
+    """
+    from sqlalchemy.sql.elements import BindParameter
+
+    return (
+        isinstance(value, BindParameter)
+        and value.required
+        and value.callable is None
+    )
+
+
+def is_factory(result):
+    """
+    Check whether data spec result is a factory of the result-set
+
+    For example::
+
+        >>> is_factory(lambda id: [id])
+        True
+        >>> is_factory([1, 2])
+        False
+        >>> is_factory(mock.MagicMock())
+        False
+    """
+    return callable(result) and not isinstance(result, mock.NonCallableMock)
+
+
+def signature(value):
+    """
+    Get hashable structural signature of a call argument
+
+    Values which can match each other either exactly or via template
+    placeholders have equal signatures hence signatures can be used
+    to look up candidate matches. ``mock.ANY`` matches any value
+    and therefore cannot have a signature.
+
+    For example::
+
+        >>> from sqlalchemy import bindparam
+        >>> from sqlalchemy.sql.expression import column
+        >>> c = column('column')
+        >>> signature(c == 5) == signature(c == bindparam('foo'))
+        True
+        >>> signature(c == 5) == signature(c > 5)
+        False
+        >>> signature(5) == signature(bindparam('foo'))
+        True
+        >>> signature(mock.ANY)
+        Traceback (most recent call last):
+        ...
+        TypeError: mock.ANY cannot have a signature
+    """
+    if isinstance(value, type(mock.ANY)):
+        raise TypeError("mock.ANY cannot have a signature")
+
+    if isinstance(value, get_alchemy_types()):
+        return type(value), compile_structure(value)[0]
+
+    # classes cannot be placeholders hence they are matched exactly
+    # which keeps common query(Model) criteria selective
+    if isinstance(value, type):
+        return type, value
+
+    return VALUE
+
+
+def call_signature(call, unordered=False):
+    """
+    Get hashable structural signature of ``(name, args, kwargs)`` call
+
+    Signature of unordered calls such as ``filter`` does not depend
+    on the order of its arguments.
+    """
+    name, args, kwargs = call
+    args = [signature(i) for i in args]
+    return (
+        name,
+        frozenset(Counter(args).items()) if unordered else tuple(args),
+        frozenset(
+            (match_type(k, six.text_type), signature(v))
+            for k, v in kwargs.items()
+        ),
+    )
+
+
+def _capture(captured, name, value):
+    if name in captured:
+        return ExpressionMatcher(captured[name]) == value
+    captured[name] = value
+    return True
+
+
+class ArgumentTemplate(object):
+    """
+    Precompiled matcher of a single call argument of data spec criteria
+
+    For example::
+
+        >>> from sqlalchemy import bindparam
+        >>> from sqlalchemy.sql.expression import column
+        >>> c = column('column')
+        >>> t = ArgumentTemplate((c == bindparam('foo')) & (c != mock.ANY))
+        >>> captured = {}
+        >>> t.match((c == 5) & (c != 6), captured), captured
+        (True, {'foo': 5})
+        >>> t.match((c == 5) | (c != 6), {})
+        False
+        >>> t.match(c == 5, {})
+        False
+        >>> t.match((c == 6) & (c != 6), {'foo': 5})
+        False
+        >>> t = ArgumentTemplate((c == bindparam('foo')) & (c != 5))
+        >>> t.match((c == 5) & (c != 6), {})
+        False
+
+    Arguments without placeholders are simply compared
+    with ``ExpressionMatcher``::
+
+        >>> ArgumentTemplate(c == 5).match(c == 5, {})
+        True
+        >>> ArgumentTemplate(mock.ANY).match(c == 5, {})
+        True
+        >>> captured = {}
+        >>> ArgumentTemplate(bindparam('foo')).match('bar', captured), captured
+        (True, {'foo': 'bar'})
+    """
+
+    __slots__ = ["value", "sql", "binds"]
+
+    def __init__(self, value):
+        self.value = value
+        self.sql = self.binds = None
+
+        if isinstance(value, get_alchemy_types()):
+            sql, binds = compile_structure(value)
+            binds = [self._compile_bind(i) for i in binds]
+            if any(kind != VALUE for kind, _ in binds):
+                self.sql, self.binds = sql, binds
+
+    @staticmethod
+    def _compile_bind(bind):
+        if is_placeholder(bind):
+            return CAPTURE, bind.key
+        if isinstance(bind.effective_value, type(mock.ANY)):
+            return ANY, None
+        return VALUE, bind.effective_value
+
+    def match(self, other, captured):
+        """
+        Match given argument while storing captured values in ``captured``
+        """
+        if is_placeholder(self.value):
+            return _capture(captured, self.value.key, other)
+
+        if self.binds is None or isinstance(other, type(mock.ANY)):
+            return ExpressionMatcher(self.value) == other
+
+        if type(other) is not type(self.value):
+            return False
+
+        sql, binds = compile_structure(other)
+        if sql != self.sql:
+            return False
+
+        for (kind, value), bind in zip(self.binds, binds):
+            if kind == CAPTURE:
+                if not _capture(captured, value, bind.effective_value):
+                    return False
+            elif kind == VALUE:
+                if not ExpressionMatcher(value) == bind.effective_value:
+                    return False
+
+        return True
+
+
+class CallTemplate(object):
+    """
+    Precompiled matcher of a single ``(name, args, kwargs)`` call
+    of data spec criteria
+
+    For example::
+
+        >>> from sqlalchemy import bindparam
+        >>> from sqlalchemy.sql.expression import column
+        >>> c = column('column')
+        >>> t = CallTemplate(
+        ...     mock.call.filter(c == bindparam('foo'), c != bindparam('bar')),
+        ...     unordered=True,
+        ... )
+        >>> sorted(t.match(mock.call.filter(c != 1, c == 2), {}).items())
+        [('bar', 1), ('foo', 2)]
+        >>> t.match(mock.call.filter(c != 1, c != 2), {})
+        >>> t.match(mock.call.order_by(c != 1, c == 2), {})
+        >>> CallTemplate(mock.call.filter_by(name=bindparam('name'))).match(
+        ...     mock.call.filter_by(name='foo'), {},
+        ... )
+        {'name': 'foo'}
+        >>> CallTemplate(mock.call.filter_by(name='foo', id=5)).match(
+        ...     mock.call.filter_by(name='bar', id=5), {},
+        ... )
+    """
+
+    __slots__ = ["name", "args", "kwargs", "unordered"]
+
+    def __init__(self, call, unordered=False):
+        name, args, kwargs = call
+        self.name = name
+        self.args = [ArgumentTemplate(i) for i in args]
+        self.kwargs = {k: ArgumentTemplate(v) for k, v in kwargs.items()}
+        self.unordered = unordered
+
+    @property
+    def signature(self):
+        return call_signature(
+            (
+                self.name,
+                [i.value for i in self.args],
+                {k: v.value for k, v in self.kwargs.items()},
+            ),
+            self.unordered,
+        )
+
+    def match(self, call, captured):
+        """
+        Match given call and return new dict of captured values
+        or ``None`` when call does not match
+        """
+        name, args, kwargs = call
+        if (
+            name != self.name
+            or len(args) != len(self.args)
+            or set(kwargs) != set(self.kwargs)
+        ):
+            return None
+
+        captured = dict(captured)
+        for k, template in self.kwargs.items():
+            if not template.match(kwargs[k], captured):
+                return None
+
+        if self.unordered:
+            return self._match_unordered(self.args, list(args), captured)
+
+        for template, arg in zip(self.args, args):
+            if not template.match(arg, captured):
+                return None
+        return captured
+
+    def _match_unordered(self, templates, args, captured):
+        if not templates:
+            return captured
+
+        for i, arg in enumerate(args):
+            _captured = dict(captured)
+            if templates[0].match(arg, _captured):
+                rest = list(args)
+                rest.pop(i)
+                _captured = self._match_unordered(
+                    templates[1:], rest, _captured
+                )
+                if _captured is not None:
+                    return _captured
+
+        return None
+
+
+class DataEntry(object):
+    """
+    Precompiled ``(criteria, result)`` entry of data spec
+    """
+
+    __slots__ = ["criteria", "result", "order", "calls", "signatures"]
+
+    def __init__(self, criteria, result, order, unordered=()):
+        self.criteria = criteria
+        self.result = result
+        self.order = order
+        self.calls = [CallTemplate(i, i[0] in unordered) for i in criteria]
+
+        self.signatures = set()
+        for call in self.calls:
+            try:
+                self.signatures.add(call.signature)
+            except TypeError:
+                pass
+
+    def match(self, calls):
+        """
+        Match query calls grouped by their name and return
+        result-set of this entry or ``None`` when it does not match
+        """
+        captured = {}
+        for template in self.calls:
+            captured = next(
+                (
+                    i
+                    for i in (
+                        template.match(call, captured)
+                        for call in calls.get(template.name, ())
+                    )
+                    if i is not None
+                ),
+                None,
+            )
+            if captured is None:
+                return None
+
+        if is_factory(self.result):
+            return self.result(**captured)
+        return self.result
+
+    def contains(self, call):
+        """
+        Check whether criteria of this entry contains given call
+        """
+        return any(i.match(call, {}) is not None for i in self.calls)
+
+
+class DataIndex(object):
+    """
+    Index of data spec entries by structural signatures of their calls
+
+    Each entry is indexed by the signature of its most selective call.
+    Since all calls of an entry must match a query, only entries indexed
+    by signatures of the query calls can possibly match it.
+    Matches are still resolved in data spec order where entries
+    with more criteria take precedence.
+
+    For example::
+
+        >>> from sqlalchemy import bindparam
+        >>> from sqlalchemy.sql.expression import column
+        >>> c = column('column')
+        >>> index = DataIndex([
+        ...     ([mock.call.query('foo')], ['foo']),
+        ...     (
+        ...         [mock.call.query('foo'), mock.call.filter(c == bindparam('id'))],
+        ...         lambda id: ['foo{}'.format(id)],
+        ...     ),
+        ...     ([mock.call.filter(mock.ANY)], ['any']),
+        ... ], unordered={'filter'})
+        >>> index.match([('query', ('foo',), {}), ('filter', (c == 5,), {})])
+        ['foo5']
+        >>> index.match([('query', ('foo',), {}), ('filter', (c > 5,), {})])
+        ['foo']
+        >>> index.match([('query', ('bar',), {}), ('filter', (c > 5,), {})])
+        ['any']
+        >>> index.match([('query', ('bar',), {}), ('filter', (mock.ANY,), {})])
+        ['any']
+        >>> index.match([('query', ('bar',), {})])
+        >>> index.get_results(('query', ('foo',), {}))
+        [['foo']]
+    """
+
+    def __init__(self, data, unordered=()):
+        self.entries = [
+            DataEntry(criteria, result, i, unordered)
+            for i, (criteria, result) in enumerate(
+                sorted(data, key=lambda x: len(x[0]), reverse=True)
+            )
+        ]
+        self.unordered = unordered
+        self.index = defaultdict(list)
+        self.unindexed = []
+
+        counts = Counter(
+            chain.from_iterable(i.signatures for i in self.entries)
+        )
+        for entry in self.entries:
+            if entry.signatures:
+                self.index[
+                    min(entry.signatures, key=counts.__getitem__)
+                ].append(entry)
+            else:
+                self.unindexed.append(entry)
+
+    def candidates(self, calls):
+        """
+        Get all entries which can possibly match given query calls
+        """
+        try:
+            signatures = {
+                call_signature(i, i[0] in self.unordered) for i in calls
+            }
+        except TypeError:
+            return self.entries
+
+        return sorted(
+            chain(
+                self.unindexed,
+                *[self.index[i] for i in signatures if i in self.index]
+            ),
+            key=lambda i: i.order,
+        )
+
+    def match(self, calls):
+        """
+        Get result-set of the first entry matching given
+        ``(name, args, kwargs)`` query calls or ``None``
+        """
+        return self.lookup(calls)[1]
+
+    def lookup(self, calls):
+        """
+        Get ``(entry, result)`` of the first entry matching given
+        ``(name, args, kwargs)`` query calls or ``(None, None)``
+        """
+        grouped = defaultdict(list)
+        for call in calls:
+            grouped[call[0]].append(call)
+
+        for entry in self.candidates(calls):
+            result = entry.match(grouped)
+            if result is not None:
+                return entry, result
+
+        return None, None
+
+    def get_results(self, query_call):
+        """
+        Get all result-sets of entries containing given query call
+
+        Result-sets are not chained together so that compact result-sets
+        do not need to build all of their instances.
+        """
+        return [
+            i.result
+            for i in self.entries
+            if not is_factory(i.result) and i.contains(query_call)
+        ]
@@ -1,24 +1,52 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
+from collections import Counter
 from functools import partial
-from itertools import chain, takewhile
+from itertools import takewhile
 
-from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
+import six
 
-from .comparison import ExpressionMatcher
+from .aggregation import AggregateQuery, ExistsResult, scalar_value
+from .compact import get_identity
+from .comparison import ExpressionMatcher, expression_key
 from .compat import mock
+from .matching import DataIndex
+from .relationships import resolve_relationships
+from .store import (
+    JournaledStore,
+    PendingTransaction,
+    SavepointTransaction,
+    identity_key,
+)
 from .utils import (
-    build_identity_map,
+    LazyString,
     copy_and_update,
+    create_sqlite_session,
     indexof,
     raiser,
     setattr_tmp,
+    stopwatch,
 )
 
 
 Call = type(mock.call)
 
 
+def orm_exc():
+    """
+    Get ``sqlalchemy.orm.exc`` module on first use
+    since importing SQLAlchemy ORM is slow
+
+    For example::
+
+        >>> orm_exc().NoResultFound
+        <class 'sqlalchemy.orm.exc.NoResultFound'>
+    """
+    from sqlalchemy.orm import exc
+
+    return exc
+
+
 class UnorderedTuple(tuple):
     """
     Same as tuple except in comparison order does not matter
@@ -27,6 +55,10 @@ class UnorderedTuple(tuple):
 
         >>> UnorderedTuple((1, 2, 3)) == (3, 2, 1)
         True
+        >>> UnorderedTuple((1, 2, 3)) == (3, 2, 4)
+        False
+        >>> UnorderedTuple((1, 2, 3)) == (3, 2)
+        False
     """
 
     def __eq__(self, other):
@@ -116,44 +148,117 @@ class AlchemyMagicMock(mock.MagicMock):
         ...
         AssertionError: Expected call: filter(BinaryExpression(sql='"column" = :column_1', params={'column_1': 10}))
         Actual call: filter(BinaryExpression(sql='"column" = :column_1', params={'column_1': 5}))
+        >>> _ = s.filter.assert_any_call(c == 10)
+        Traceback (most recent call last):
+        ...
+        AssertionError: filter(BinaryExpression(sql='"column" = :column_1', params={'column_1': 10})) call not found
+        >>> _ = s.filter.assert_has_calls([mock.call(c == 10)])
+        Traceback (most recent call last):
+        ...
+        AssertionError: Calls not found.
+        >>> _ = s.filter.assert_has_calls([mock.call(c == 10)], any_order=True)
+        Traceback (most recent call last):
+        ...
+        AssertionError: 'filter' does not contain all of ...
+
+    Failure messages are only rendered when they are displayed
+    which makes negative checks of assertions cheap::
+
+        >>> try:
+        ...     s.filter.assert_any_call(c == 10)
+        ... except AssertionError as e:
+        ...     error = e
+        >>> error.args[0]._value is None
+        True
+        >>> print(error)
+        filter(BinaryExpression(sql='"column" = :column_1', params={'column_1': 10})) call not found
+
+    Calls of mocks with ``spec`` are matched by signature of the spec::
+
+        >>> def func(a, b):
+        ...     pass
+        >>> m = AlchemyMagicMock(spec=func)
+        >>> _ = m(1, b=2)
+        >>> m.assert_any_call(1, 2)
+        >>> m.assert_has_calls([mock.call(1, 2)])
     """
 
     def __init__(self, *args, **kwargs):
         kwargs.setdefault("__name__", "Session")
         super(AlchemyMagicMock, self).__init__(*args, **kwargs)
+        # call signatures are not rendered while checking assertions
+        # since failure messages are only rendered when displayed
+        self._mock_render_calls = True
 
     def _format_mock_call_signature(self, args, kwargs):
+        if not self._mock_render_calls:
+            return ""
+        return LazyString(self._render_mock_call_signature, args, kwargs)
+
+    def _render_mock_call_signature(self, args, kwargs):
         name = self._mock_name or "mock"
         args, kwargs = sqlalchemy_call(mock.call(*args, **kwargs))
         return mock._format_call_signature(name, args, kwargs)
 
+    def _format_mock_failure_message(self, *args, **kwargs):
+        return LazyString(
+            super(AlchemyMagicMock, self)._format_mock_failure_message,
+            *args,
+            **kwargs
+        )
+
+    @stopwatch.timed
     def assert_called_with(self, *args, **kwargs):
         args, kwargs = sqlalchemy_call(mock.call(*args, **kwargs))
         return super(AlchemyMagicMock, self).assert_called_with(*args, **kwargs)
 
+    @stopwatch.timed
     def assert_any_call(self, *args, **kwargs):
         args, kwargs = sqlalchemy_call(mock.call(*args, **kwargs))
-        with setattr_tmp(
-            self,
+        return self._assert_lazily(
             "call_args_list",
             [sqlalchemy_call(i) for i in self.call_args_list],
-        ):
-            return super(AlchemyMagicMock, self).assert_any_call(
-                *args, **kwargs
-            )
+            super(AlchemyMagicMock, self).assert_any_call,
+            *args,
+            **kwargs
+        )
 
+    @stopwatch.timed
     def assert_has_calls(self, calls, any_order=False):
-        calls = [sqlalchemy_call(i) for i in calls]
-        with setattr_tmp(
-            self,
+        return self._assert_lazily(
             "mock_calls",
             type(self.mock_calls)(
                 [sqlalchemy_call(i) for i in self.mock_calls]
             ),
+            super(AlchemyMagicMock, self).assert_has_calls,
+            [sqlalchemy_call(i) for i in calls],
+            any_order,
+        )
+
+    def _assert_lazily(self, name, value, assertion, *args, **kwargs):
+        # original assertion checks calls with given attribute replaced
+        # and is only rerun to render its message once it is displayed
+        with setattr_tmp(self, name, value), setattr_tmp(
+            self, "_mock_render_calls", False
         ):
-            return super(AlchemyMagicMock, self).assert_has_calls(
-                calls, any_order
+            try:
+                return assertion(*args, **kwargs)
+            except AssertionError:
+                pass
+
+        raise AssertionError(
+            LazyString(
+                self._render_failure, name, value, assertion, *args, **kwargs
             )
+        )
+
+    def _render_failure(self, name, value, assertion, *args, **kwargs):
+        # value is a snapshot of calls hence assertion fails the same way
+        with setattr_tmp(self, name, value):
+            try:
+                assertion(*args, **kwargs)
+            except AssertionError as e:
+                return six.text_type(e)
 
 
 class UnifiedAlchemyMagicMock(AlchemyMagicMock):
@@ -265,6 +370,7 @@ class UnifiedAlchemyMagicMock(AlchemyMagicMock):
         >>> s.query('foo').filter(c == 'three').get((1, 1))
         1
         >>> s.query('foo').filter(c == 'three').get((4, 4))
+        >>> UnifiedAlchemyMagicMock().query('foo').get((1, 1))
 
         # dynamic session
         >>> s = UnifiedAlchemyMagicMock()
@@ -280,12 +386,290 @@ class UnifiedAlchemyMagicMock(AlchemyMagicMock):
         >>> s.query(SomeClass).filter(c == 'one').all()
         [1, 2]
 
+    Deletes, merges and transactions are supported as well.
+    All mutations are journaled so they can be rolled back
+    either to last commit or to a savepoint::
+
+        >>> s.commit()
+        >>> s.delete(s.query(SomeClass).get((1, 1)))
+        >>> s.query(SomeClass).all()
+        [2]
+        >>> nested = s.begin_nested()
+        >>> s.merge(SomeClass(pk1=2, pk2=2, name='two'))
+        2
+        >>> s.query(SomeClass).get((2, 2)).name
+        'two'
+        >>> s.add(SomeClass(pk1=3, pk2=3))
+        >>> s.query(SomeClass).all()
+        [2, 3]
+        >>> nested.rollback()
+        >>> s.query(SomeClass).get((2, 2)).name
+        >>> s.query(SomeClass).all()
+        [2]
+        >>> s.flush()
+        >>> s.rollback()
+        >>> s.query(SomeClass).all()
+        [1, 2]
+
+    Matched data is cached per normalized query fingerprint
+    so repeated queries skip matching altogether.
+    Cache is cleared on any data mutation::
+
+        >>> s = UnifiedAlchemyMagicMock(data=[
+        ...     ([mock.call.query('foo'), mock.call.filter(c == 'one', c == 'two')], [1]),
+        ... ])
+        >>> [s.query('foo').filter(c == 'one').filter(c == 'two').all() for _ in range(3)]
+        [[1], [1], [1]]
+        >>> s.query('foo').filter(c == 'two', c == 'one').count()
+        1
+        >>> s.query('foo').filter(mock.ANY, mock.ANY).all()
+        [1]
+        >>> len(s._mock_store.cache)
+        1
+        >>> s.add(SomeClass(pk1=1, pk2=1))
+        >>> len(s._mock_store.cache)
+        0
+
+    Criteria can also be templates with ``bindparam()`` placeholders
+    which capture actual values or with ``mock.ANY`` values
+    which match any value. When result is callable, it is called
+    with all captured values to produce the result-set.
+    Templates are compiled once hence single entry can serve
+    any number of parameter variants::
+
+        >>> from sqlalchemy import bindparam
+        >>> s = UnifiedAlchemyMagicMock(data=[
+        ...     (
+        ...         [mock.call.query(SomeClass),
+        ...          mock.call.filter(SomeClass.pk1 == bindparam('pk'),
+        ...                           SomeClass.name != mock.ANY)],
+        ...         lambda pk: [SomeClass(pk1=pk, pk2=pk)],
+        ...     ),
+        ...     (
+        ...         [mock.call.query(SomeClass),
+        ...          mock.call.filter_by(name=bindparam('name'))],
+        ...         lambda name: [SomeClass(pk1=len(name), pk2=0, name=name)],
+        ...     ),
+        ... ])
+        >>> s.query(SomeClass).filter(SomeClass.name != 'foo').filter(SomeClass.pk1 == 7).all()
+        [7]
+        >>> s.query(SomeClass).filter_by(name='three').one().name
+        'three'
+        >>> s.query(SomeClass).filter(SomeClass.pk1 == 7).all()
+        []
+
+    Results of templates are not stored hence mutations
+    do not affect them::
+
+        >>> s.add(SomeClass(pk1=1, pk2=1))
+        >>> s.merge(SomeClass(pk1=1, pk2=1, name='one')).name
+        'one'
+        >>> s.delete(s.query(SomeClass).get((1, 1)))
+        >>> s.query(SomeClass).all()
+        []
+        >>> s.query(SomeClass).filter_by(name='one').all()
+        [3]
+
+    Relationships of stored objects are resolved via their foreign keys.
+    Joins along relationships only return objects which have related objects
+    and eager loading options such as ``joinedload`` populate relationships::
+
+        >>> from sqlalchemy import ForeignKey
+        >>> from sqlalchemy.orm import joinedload, relationship
+
+        >>> class Parent(Base):
+        ...     __tablename__ = 'parent'
+        ...     id = Column(Integer, primary_key=True)
+        ...     children = relationship('Child', backref='parent')
+        ...     def __repr__(self):
+        ...         return 'Parent({})'.format(self.id)
+
+        >>> class Child(Base):
+        ...     __tablename__ = 'child'
+        ...     id = Column(Integer, primary_key=True)
+        ...     parent_id = Column(ForeignKey('parent.id'))
+        ...     def __repr__(self):
+        ...         return 'Child({})'.format(self.id)
+
+        >>> s = UnifiedAlchemyMagicMock(data=[
+        ...     (
+        ...         [mock.call.query(Child)],
+        ...         [Child(id=1, parent_id=1), Child(id=2, parent_id=1)],
+        ...     ),
+        ...     (
+        ...         [mock.call.query(Parent), mock.call.filter(Parent.id == 1)],
+        ...         [Parent(id=1)],
+        ...     ),
+        ...     (
+        ...         [mock.call.query(Child), mock.call.filter_by(id=bindparam('id'))],
+        ...         lambda id: [Child(id=id)],
+        ...     ),
+        ... ])
+        >>> s.add_all([Parent(id=1), Parent(id=2)])
+        >>> s.query(Parent).join(Parent.children).all()
+        [Parent(1)]
+        >>> [p.children for p in s.query(Parent).options(joinedload(Parent.children))]
+        [[Child(1), Child(2)], []]
+        >>> s.query(Child).options(joinedload('parent')).get((2,)).parent
+        Parent(1)
+
+    Foreign keys changed directly on stored objects are picked up
+    on flush or commit::
+
+        >>> s.query(Child).get((2,)).parent_id = 2
+        >>> s.flush()
+        >>> s.query(Parent).join(Parent.children).all()
+        [Parent(1), Parent(2)]
+        >>> [p.children for p in s.query(Parent).options(joinedload(Parent.children))]
+        [[Child(1)], [Child(2)]]
+
+    Joins and options which are part of matched mock data criteria
+    are not resolved since stubbed result is expected to reflect them::
+
+        >>> s = UnifiedAlchemyMagicMock(data=[
+        ...     ([mock.call.query(Parent), mock.call.join(Parent.children)], [Parent(id=2)]),
+        ... ])
+        >>> s.query(Parent).join(Parent.children).all()
+        [Parent(2)]
+
+    Aggregate queries of ``count``, ``sum``, ``min``, ``max`` and ``avg``
+    as well as ``group_by`` queries which are not stubbed are evaluated
+    over rows which same query of the model would return::
+
+        >>> from sqlalchemy import func
+        >>> s = UnifiedAlchemyMagicMock(data=[
+        ...     (
+        ...         [mock.call.query(SomeClass)],
+        ...         [SomeClass(pk1=1, pk2=1, name='one'),
+        ...          SomeClass(pk1=2, pk2=1, name='two'),
+        ...          SomeClass(pk1=3, pk2=2, name='two')],
+        ...     ),
+        ...     (
+        ...         [mock.call.query(SomeClass), mock.call.filter(SomeClass.name == 'one')],
+        ...         [SomeClass(pk1=1, pk2=1, name='one')],
+        ...     ),
+        ... ])
+        >>> s.query(func.count(SomeClass.pk1)).scalar()
+        3
+        >>> s.query(func.sum(SomeClass.pk1), func.avg(SomeClass.pk2)).filter(SomeClass.name == 'one').one()
+        (1, 1.0)
+        >>> s.query(SomeClass.name, func.count()).group_by(SomeClass.name).all()
+        [('one', 1), ('two', 2)]
+        >>> s.query(SomeClass.name).add_columns(func.max(SomeClass.pk1).label('max')).group_by(SomeClass.name).count()
+        2
+
+    Queries of models without any stored rows are not evaluated
+    and same as any other unmatched query they return ``default``::
+
+        >>> s.query(func.count(Parent.id)).all()
+        []
+        >>> UnifiedAlchemyMagicMock(default=[(5,)]).query(func.count(SomeClass.pk1)).all()
+        [(5,)]
+
+    Same as with a real session, ``scalar()`` returns first column of the only
+    row and existence of rows can be queried with ``exists()``::
+
+        >>> s.query(SomeClass).filter(SomeClass.name == 'one').scalar()
+        1
+        >>> s.query(SomeClass).scalar()
+        Traceback (most recent call last):
+        ...
+        MultipleResultsFound: Multiple rows were found for one()
+        >>> s.query(s.query(SomeClass).filter(SomeClass.name == 'one').exists()).scalar()
+        True
+        >>> s.query(s.query(Parent).exists()).scalar()
+        False
+
+    Optionally queries which do not match any mock data can fallback
+    to in-memory SQLite database created from given metadata.
+    In that case added models are not stored in mock data
+    but are instead mirrored into the database in batches right before
+    a query needs to be evaluated. That allows to still use mock data for stubs
+    while getting correct results for more complex queries::
+
+        >>> s = UnifiedAlchemyMagicMock(
+        ...     fallback=Base.metadata,
+        ...     data=[
+        ...         (
+        ...             [mock.call.query(SomeClass),
+        ...              mock.call.filter(SomeClass.name == 'stub')],
+        ...             [SomeClass(pk1=5, pk2=5)]
+        ...         ),
+        ...     ],
+        ... )
+        >>> s.add(SomeClass(pk1=1, pk2=1, name='one'))
+        >>> s.add_all([SomeClass(pk1=2, pk2=2, name='two')])
+        >>> s.query(SomeClass).filter(SomeClass.name == 'stub').all()
+        [5]
+        >>> s.query(SomeClass).filter(SomeClass.name == 'two').all()
+        [2]
+        >>> s.query(SomeClass).order_by(SomeClass.pk1.desc()).limit(1).first()
+        2
+        >>> list(s.query(SomeClass).filter(SomeClass.pk1 > 0))
+        [1, 2]
+        >>> s.query(SomeClass).get((1, 1))
+        1
+        >>> s.query(SomeClass).get((5, 5))
+        5
+        >>> s.query(func.count(SomeClass.pk1)).scalar()
+        2
+        >>> s.query(s.query(SomeClass).exists()).scalar()
+        True
+
+    Query calls are applied to the database in the order they were made::
+
+        >>> s.add_all([Parent(id=1), Parent(id=2)])
+        >>> s.add_all([Child(id=1, parent_id=2), Child(id=2, parent_id=1)])
+        >>> s.query(Parent).filter_by(id=1).join(Parent.children).all()
+        [Parent(1)]
+        >>> s.query(Parent).join(Parent.children).filter_by(id=1).all()
+        [Parent(2)]
+
+    Mutations are then applied to the database directly::
+
+        >>> s.commit()
+        >>> s.delete(s.query(SomeClass).get((1, 1)))
+        >>> s.add(SomeClass(pk1=3, pk2=3, name='three'))
+        >>> s.query(SomeClass).filter(SomeClass.pk1 > 0).all()
+        [2, 3]
+        >>> s.add(SomeClass(pk1=4, pk2=4, name='four'))
+        >>> s.rollback()
+        >>> s.query(SomeClass).filter(SomeClass.pk1 > 0).all()
+        [1, 2]
+
+    other than mutations of stubbed instances which are applied
+    to mock data and are rolled back together with the database::
+
+        >>> stub = s.query(SomeClass).filter(SomeClass.name == 'stub').one()
+        >>> savepoint = s.begin_nested()
+        >>> s.merge(SomeClass(pk1=5, pk2=5, name='merged')) is stub, stub.name
+        (True, 'merged')
+        >>> s.delete(stub)
+        >>> s.delete(s.query(SomeClass).get((2, 2)))
+        >>> s.query(SomeClass).filter(SomeClass.name == 'stub').all()
+        []
+        >>> s.query(SomeClass).get((5, 5)), s.query(SomeClass).get((2, 2))
+        (None, None)
+        >>> savepoint.rollback()
+        >>> s.query(SomeClass).filter(SomeClass.name == 'stub').all()
+        [5]
+        >>> stub.name, s.query(SomeClass).get((2, 2))
+        (None, 2)
+        >>> five = SomeClass(pk1=5, pk2=5, name='five')
+        >>> with s.begin_nested():
+        ...     s.add(five)
+        ...     s.delete(five)
+        >>> s.query(SomeClass).filter(SomeClass.name == 'stub').all()
+        [5]
+        >>> s.query(SomeClass).filter(SomeClass.pk1 > 0).all()
+        [1, 2]
+
     Also note that only within same query functions are unified.
     After ``.all()`` is called or query is iterated over, future queries are not unified.
     """
 
     boundary = {
-        "all": lambda x: x,
+        "all": lambda x: list(x),
         "__iter__": lambda x: iter(x),
         "count": lambda x: len(x),
         "first": lambda x: next(iter(x), None),
@@ -293,22 +677,35 @@ class UnifiedAlchemyMagicMock(AlchemyMagicMock):
             x[0]
             if len(x) == 1
             else raiser(
-                MultipleResultsFound, "Multiple rows were found for one()"
+                orm_exc().MultipleResultsFound,
+                "Multiple rows were found for one()",
             )
             if x
-            else raiser(NoResultFound, "No row was found for one()")
+            else raiser(orm_exc().NoResultFound, "No row was found for one()")
         ),
         "one_or_none": lambda x: (
             x[0]
             if len(x) == 1
             else raiser(
-                MultipleResultsFound,
+                orm_exc().MultipleResultsFound,
                 "Multiple rows were found for one_or_none()",
             )
             if x
             else None
         ),
-        "get": lambda x, idmap: build_identity_map(x).get(idmap),
+        "scalar": lambda x: (
+            scalar_value(x[0])
+            if len(x) == 1
+            else raiser(
+                orm_exc().MultipleResultsFound,
+                "Multiple rows were found for one()",
+            )
+            if x
+            else None
+        ),
+        "exists": lambda x: ExistsResult(bool(x)),
+        # get looks up identity in all matched result-sets
+        "get": lambda x, idmap: get_identity(x, idmap),
     }
     unify = {
         "query": None,
@@ -323,11 +720,65 @@ class UnifiedAlchemyMagicMock(AlchemyMagicMock):
         "distinct": None,
     }
 
-    mutate = {"add", "add_all"}
+    mutate = {
+        "add",
+        "add_all",
+        "delete",
+        "merge",
+        "flush",
+        "commit",
+        "rollback",
+        "begin_nested",
+    }
+
+    isolation_levels = ("READ UNCOMMITTED", "READ COMMITTED")
+
+    # unified calls which are applied to a real query
+    # when falling back to a real database
+    fallback_calls = {
+        "query",
+        "add_columns",
+        "join",
+        "options",
+        "filter",
+        "filter_by",
+        "group_by",
+        "order_by",
+        "distinct",
+        "limit",
+    }
 
     def __init__(self, *args, **kwargs):
+        store = kwargs.pop("store", None)
+        data = kwargs.pop("data", None)
+        if store is None:
+            store = JournaledStore(data)
+        elif data is not None:
+            raise TypeError("data cannot be given together with store")
+        isolation_level = kwargs.pop("isolation_level", "READ UNCOMMITTED")
+        if isolation_level not in self.isolation_levels:
+            raise ValueError(
+                "isolation_level must be one of {}".format(
+                    ", ".join(self.isolation_levels)
+                )
+            )
+        # fallback database has a single transaction shared by all sessions
+        if isolation_level != "READ UNCOMMITTED" and kwargs.get("fallback"):
+            raise ValueError(
+                "fallback only supports READ UNCOMMITTED isolation_level"
+            )
+
         kwargs["_mock_default"] = kwargs.pop("default", [])
-        kwargs["_mock_data"] = kwargs.pop("data", None)
+        kwargs["_mock_store"] = store
+        kwargs["_mock_data"] = store.data
+        kwargs["_mock_transaction"] = (
+            PendingTransaction(store)
+            if isolation_level == "READ COMMITTED"
+            else None
+        )
+        kwargs["_mock_fallback"] = kwargs.pop("fallback", None)
+        kwargs["_mock_fallback_session"] = kwargs.pop("fallback_session", None)
+        kwargs["_mock_fallback_pending"] = []
 
         kwargs.update(
             {
@@ -374,6 +825,7 @@ class UnifiedAlchemyMagicMock(AlchemyMagicMock):
 
         return next(iter(filter(lambda i: i[0] == name, previous_calls)), None)
 
+    @stopwatch.timed
     def _unify(self, *args, **kwargs):
         _mock_name = kwargs.pop("_mock_name")
         submock = getattr(self, _mock_name)
@@ -415,72 +867,352 @@ class UnifiedAlchemyMagicMock(AlchemyMagicMock):
 
         return submock.return_value
 
+    @stopwatch.timed
     def _get_data(self, *args, **kwargs):
         _mock_name = kwargs.pop("_mock_name")
         _mock_default = self._mock_default
-        _mock_data = self._mock_data
 
-        if _mock_data is not None:
-            previous_calls = [
-                sqlalchemy_call(
-                    i, with_name=True, base_call=self.unify.get(i[0]) or Call
+        calls = list(self._get_previous_calls(self.mock_calls[:-1]))
+        matched = self._get_matched_data(_mock_name, calls)
+
+        # aggregates which are not stubbed are evaluated over stored rows
+        if matched is None and _mock_name != "get":
+            matched = self._get_aggregate_data(calls)
+
+        if matched is not None:
+            result = self.boundary[_mock_name](matched, *args, **kwargs)
+            if _mock_name == "get" and result is not None:
+                result = next(
+                    iter(
+                        resolve_relationships(self._mock_store, calls, [result])
+                    ),
+                    None,
                 )
-                for i in self._get_previous_calls(self.mock_calls[:-1])
-            ]
-            sorted_mock_data = sorted(
-                _mock_data, key=lambda x: len(x[0]), reverse=True
+            if (
+                _mock_name != "get"
+                or result is not None
+                or self._mock_fallback is None
+            ):
+                return result
+
+        if self._mock_fallback is not None:
+            return self._get_fallback_data(_mock_name, *args, **kwargs)
+
+        if _mock_name == "get":
+            _mock_default = [_mock_default]
+        return self.boundary[_mock_name](_mock_default, *args, **kwargs)
+
+    def _get_matched_data(self, _mock_name, calls):
+        _mock_data = self._mock_data
+        _mock_transaction = self._mock_transaction
+        matched = None
+
+        if _mock_data:
+            cache = self._mock_store.cache
+            key = self._get_calls_key(_mock_name, calls)
+
+            if key is not None and key in cache:
+                matched = cache[key]
+            else:
+                matched = self._match_data(_mock_name, calls)
+                if key is not None:
+                    cache[key] = matched
+
+        if _mock_transaction is not None:
+            matched = _mock_transaction.view(
+                calls, matched, get=_mock_name == "get"
             )
 
-            if _mock_name == "get":
-                query_call = [c for c in previous_calls if c[0] == "query"][0]
-                results = list(
-                    chain(
-                        *[
-                            result
-                            for calls, result in sorted_mock_data
-                            if query_call in calls
-                        ]
+        return matched
+
+    def _get_aggregate_data(self, calls):
+        query = AggregateQuery.from_calls(calls)
+        if query is None:
+            return None
+
+        rows = []
+        if query.model is not None:
+            rows = self._get_matched_data("all", query.source_calls(calls))
+            # without any stored rows of the model query is answered
+            # by default or by fallback as any other unmatched query
+            if rows is None:
+                return None
+
+        return query.evaluate(rows)
+
+    def _match_data(self, _mock_name, calls):
+        _mock_store = self._mock_store
+        if _mock_store.index is None:
+            _mock_store.index = DataIndex(
+                self._mock_data, {k for k, v in self.unify.items() if v}
+            )
+
+        # relationships of instance returned by get are resolved
+        # only once it is looked up in all result-sets
+        if _mock_name == "get":
+            query_call = [c for c in calls if c[0] == "query"][0]
+            return _mock_store.index.get_results(query_call)
+
+        entry, result = _mock_store.index.lookup(calls)
+        if entry is None:
+            return None
+
+        # calls explicitly stubbed by mock data are not resolved
+        # since stubbed results are expected to already reflect them
+        return resolve_relationships(
+            _mock_store,
+            calls,
+            result,
+            skip={i[0] for i in entry.criteria},
+        )
+
+    def _get_calls_key(self, _mock_name, calls):
+        """
+        Get normalized fingerprint of query calls
+        which is used to cache matched data
+
+        Returns ``None`` when calls cannot be fingerprinted
+        such as when they contain unhashable values.
+        """
+        if _mock_name == "get":
+            calls = [i for i in calls if i[0] == "query"][:1]
+
+        try:
+            return (
+                _mock_name == "get",
+                frozenset(
+                    (
+                        name,
+                        # unordered calls such as filter are fingerprinted
+                        # by multiset of their arguments
+                        frozenset(Counter(map(expression_key, args)).items())
+                        if self.unify.get(name)
+                        else tuple(map(expression_key, args)),
+                        expression_key(kwargs),
                     )
-                )
-                return self.boundary[_mock_name](results, *args, **kwargs)
+                    for name, args, kwargs in calls
+                ),
+            )
+        except TypeError:
+            return None
 
-            else:
-                for calls, result in sorted_mock_data:
-                    calls = [
-                        sqlalchemy_call(
-                            i,
-                            with_name=True,
-                            base_call=self.unify.get(i[0]) or Call,
-                        )
-                        for i in calls
-                    ]
-                    if all(c in previous_calls for c in calls):
-                        return self.boundary[_mock_name](
-                            result, *args, **kwargs
-                        )
+    def _get_fallback_session(self):
+        if self._mock_fallback_session is None:
+            self._mock_fallback_session = create_sqlite_session(
+                self._mock_fallback
+            )
+        session = self._mock_fallback_session
 
-        return self.boundary[_mock_name](_mock_default, *args, **kwargs)
+        # mirror all added models in a single batch
+        if self._mock_fallback_pending:
+            session.add_all(self._mock_fallback_pending)
+            session.flush()
+            del self._mock_fallback_pending[:]
 
+        return session
+
+    def _get_fallback_data(self, _mock_name, *args, **kwargs):
+        session = self._get_fallback_session()
+
+        # calls are applied in order they were made since for example
+        # filter_by() applies to the entity last joined before it
+        calls = reversed(
+            [
+                i
+                for i in self._get_previous_calls(self.mock_calls[:-1])
+                if i[0] in self.fallback_calls
+            ]
+        )
+        query = session
+        for name, args_, kwargs_ in calls:
+            query = getattr(query, name)(*args_, **kwargs_)
+
+        if _mock_name == "__iter__":
+            return iter(query)
+        return getattr(query, _mock_name)(*args, **kwargs)
+
+    @stopwatch.timed
     def _mutate_data(self, *args, **kwargs):
         _mock_name = kwargs.get("_mock_name")
-        _mock_data = self._mock_data = self._mock_data or []
+        _mock_store = self._mock_store
+        if self._mock_transaction is not None:
+            _mock_store = self._mock_transaction
+
+        if self._mock_fallback is not None and not (
+            _mock_name in ("delete", "merge") and self._is_stubbed(args[0])
+        ):
+            result = self._mutate_fallback_data(_mock_name, *args)
+            # stubbed instances might have been mutated as well
+            if _mock_name == "begin_nested":
+                return SavepointTransaction(_mock_store, result)
+            if _mock_name not in ("flush", "commit", "rollback"):
+                return result
 
         if _mock_name == "add":
-            to_add = args[0]
-            query_call = mock.call.query(type(to_add))
+            _mock_store.add(args[0])
 
-            mocked_data = next(
-                iter(filter(lambda i: i[0] == [query_call], _mock_data)), None
-            )
-            if mocked_data:
-                mocked_data[1].append(to_add)
-            else:
-                _mock_data.append(([query_call], [to_add]))
+        elif _mock_name == "add_all":
+            for i in args[0]:
+                _mock_store.add(i)
+
+        elif _mock_name == "delete":
+            _mock_store.delete(args[0])
+
+        elif _mock_name == "merge":
+            return _mock_store.merge(args[0])
+
+        elif _mock_name == "flush":
+            _mock_store.flush()
+
+        elif _mock_name == "commit":
+            _mock_store.commit()
+
+        elif _mock_name == "rollback":
+            _mock_store.rollback()
+
+        elif _mock_name == "begin_nested":
+            return SavepointTransaction(_mock_store)
+
+    def _is_stubbed(self, instance):
+        # instances persisted in fallback database are mutated there
+        session = self._mock_fallback_session
+        if session is not None and instance in session:
+            return False
+        if any(i is instance for i in self._mock_fallback_pending):
+            return False
+        return self._mock_store.get_identity(identity_key(instance)) is not None
+
+    def _mutate_fallback_data(self, _mock_name, *args):
+        if _mock_name == "add":
+            self._mock_fallback_pending.append(args[0])
 
         elif _mock_name == "add_all":
-            to_add = args[0]
-            _kwargs = kwargs.copy()
-            _kwargs["_mock_name"] = "add"
+            self._mock_fallback_pending.extend(args[0])
 
-            for i in to_add:
-                self._mutate_data(i, *args[1:], **_kwargs)
+        else:
+            # nothing pending should be mirrored when rolling back
+            if _mock_name == "rollback":
+                del self._mock_fallback_pending[:]
+            return getattr(self._get_fallback_session(), _mock_name)(*args)
+
+
+class UnifiedAlchemySessionMaker(object):
+    """
+    ``sessionmaker`` style factory of ``UnifiedAlchemyMagicMock`` sessions
+    which all read and write through one shared store
+
+    Sessions do not copy any data hence they are cheap to create.
+
+    For example::
+
+        >>> from sqlalchemy import Column, Integer, String
+        >>> from sqlalchemy.ext.declarative import declarative_base
+
+        >>> Base = declarative_base()
+
+        >>> class SomeClass(Base):
+        ...     __tablename__ = 'some_table'
+        ...     pk1 = Column(Integer, primary_key=True)
+        ...     pk2 = Column(Integer, primary_key=True)
+        ...     name =  Column(String(50))
+        ...     def __repr__(self):
+        ...         return str(self.pk1)
+
+        >>> Session = UnifiedAlchemySessionMaker(data=[
+        ...     ([mock.call.query(SomeClass)], [SomeClass(pk1=1, pk2=1)]),
+        ... ])
+        >>> s1, s2 = Session(), Session()
+        >>> s1._mock_store is s2._mock_store
+        True
+        >>> s1.add(SomeClass(pk1=2, pk2=2))
+        >>> s1.commit()
+        >>> s2.query(SomeClass).all()
+        [1, 2]
+        >>> s2.query(SomeClass).get((2, 2))
+        2
+
+    Data can only be given to the session maker itself::
+
+        >>> Session(data=[])
+        Traceback (most recent call last):
+        ...
+        TypeError: data cannot be given together with store
+
+    By default all sessions share a single transaction so uncommitted
+    mutations are visible to all sessions and rolling back
+    in any session undoes them. With ``READ COMMITTED`` isolation level,
+    mutations are kept pending within each session
+    and are only visible to other sessions once committed::
+
+        >>> Session.configure(isolation_level='READ COMMITTED')
+        >>> s1, s2 = Session(), Session()
+        >>> s1.add(SomeClass(pk1=3, pk2=3))
+        >>> s1.delete(s1.query(SomeClass).get((1, 1)))
+        >>> s1.query(SomeClass).all()
+        [2, 3]
+        >>> s2.query(SomeClass).all()
+        [1, 2]
+        >>> s1.commit()
+        >>> s2.query(SomeClass).all()
+        [2, 3]
+
+        >>> s1.add(SomeClass(pk1=4, pk2=4))
+        >>> s1.merge(SomeClass(pk1=4, pk2=4, name='four')) is s1.query(SomeClass).get((4, 4))
+        True
+        >>> s1.merge(SomeClass(pk1=2, pk2=2, name='two')).name
+        'two'
+        >>> s1.merge(SomeClass(pk1=5, pk2=5)) in s1.query(SomeClass).all()
+        True
+        >>> s1.rollback()
+        >>> s1.query(SomeClass).all()
+        [2, 3]
+        >>> s1.merge(SomeClass(pk1=2, pk2=2, name='two')).name
+        'two'
+        >>> s1.query(SomeClass).get((2, 2)).name, s2.query(SomeClass).get((2, 2)).name
+        ('two', None)
+        >>> s1.commit()
+        >>> s2.query(SomeClass).get((2, 2)).name
+        'two'
+
+        >>> Session(isolation_level='SERIALIZABLE')
+        Traceback (most recent call last):
+        ...
+        ValueError: isolation_level must be one of READ UNCOMMITTED, READ COMMITTED
+
+    Similarly sessions with ``fallback`` share a single fallback database
+    and therefore also its single transaction::
+
+        >>> Session = UnifiedAlchemySessionMaker(fallback=Base.metadata)
+        >>> s1, s2 = Session(), Session()
+        >>> s1.add(SomeClass(pk1=1, pk2=1))
+        >>> s1.commit()
+        >>> s2.query(SomeClass).all()
+        [1]
+        >>> Session(isolation_level='READ COMMITTED')
+        Traceback (most recent call last):
+        ...
+        ValueError: fallback only supports READ UNCOMMITTED isolation_level
+    """
+
+    def __init__(self, data=None, **kwargs):
+        self.store = JournaledStore(data)
+        self.kwargs = kwargs
+        # fallback database of each fallback metadata
+        self.fallback_sessions = {}
+
+    def __call__(self, **kwargs):
+        kwargs = copy_and_update(self.kwargs, kwargs)
+        fallback = kwargs.get("fallback")
+        if fallback is not None:
+            if fallback not in self.fallback_sessions:
+                self.fallback_sessions[fallback] = create_sqlite_session(
+                    fallback
+                )
+            kwargs["fallback_session"] = self.fallback_sessions[fallback]
+        return UnifiedAlchemyMagicMock(store=self.store, **kwargs)
+
+    def configure(self, **kwargs):
+        """
+        Update arguments given to all new sessions
+        """
+        self.kwargs.update(kwargs)
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+pytest plugin for alchemy_mock
+
+Plugin is automatically registered when alchemy_mock is installed and provides:
+
+* ``alchemy_session`` fixture which is ``UnifiedAlchemyMagicMock``
+  with data from ``alchemy_mock_data`` fixture.
+  Session is created once per ``alchemy_mock_scope`` ini option
+  (``function`` by default). Its mock data is snapshotted and restored
+  after each test while pending transaction and fallback database
+  are discarded. Note that attributes changed directly on stored
+  instances, other than ones built from ``CompactRows``, are not restored.
+* explanations of failed ``ExpressionMatcher`` comparisons in asserts.
+* ``--alchemy-mock-durations=N`` report of the slowest N tests
+  by time spent within alchemy_mock.
+
+For example::
+
+    >>> import os, re, sys, tempfile, six
+    >>> tmp = tempfile.mkdtemp()
+    >>> with open(os.path.join(tmp, 'test_foo.py'), 'w') as fid:
+    ...     _ = fid.write('''
+    ... import pytest
+    ... from sqlalchemy.sql.expression import column
+    ... from alchemy_mock.comparison import ExpressionMatcher
+    ... from alchemy_mock.compat import mock
+    ...
+    ... @pytest.fixture(scope='session')
+    ... def alchemy_mock_data():
+    ...     return [([mock.call.query(int)], [1, 2])]
+    ...
+    ... def test_add(alchemy_session):
+    ...     alchemy_session.add(3)
+    ...     alchemy_session.commit()
+    ...     assert alchemy_session.query(int).all() == [1, 2, 3]
+    ...
+    ... def test_snapshot(alchemy_session):
+    ...     assert alchemy_session.query(int).all() == [1, 2]
+    ...
+    ... def test_expression():
+    ...     assert ExpressionMatcher(column('foo') == 5) == (column('foo') == 6)
+    ...
+    ... def test_other():
+    ...     assert ExpressionMatcher(column('foo') == 5) == 5
+    ... ''')
+    >>> with open(os.path.join(tmp, 'test_bar.py'), 'w') as fid:
+    ...     _ = fid.write('''
+    ... def test_default(alchemy_session):
+    ...     assert alchemy_session.query(int).all() == []
+    ... ''')
+
+    >>> def run(*args):
+    ...     stdout, sys.stdout = sys.stdout, six.StringIO()
+    ...     stderr, sys.stderr = sys.stderr, six.StringIO()
+    ...     try:
+    ...         code = pytest.main([
+    ...             tmp, '-p', 'no:alchemy_mock', '-p', 'no:cacheprovider',
+    ...             '-p', 'no:warnings', '-p', 'alchemy_mock.pytest_plugin',
+    ...         ] + list(args))
+    ...         return int(code), sys.stdout.getvalue() + sys.stderr.getvalue()
+    ...     finally:
+    ...         sys.stdout, sys.stderr = stdout, stderr
+
+    >>> code, output = run('-o', 'alchemy_mock_scope=module', '--alchemy-mock-durations=2')
+    >>> print('\\n'.join(
+    ...     i for i in output.splitlines()
+    ...     if re.match(r'E +(SQL|params):', i) or re.match(r'\\d+\\.\\d+s ', i)
+    ...     or 'slowest' in i or 'passed' in i
+    ... ))  # doctest: +ELLIPSIS
+    E         SQL: 'foo = :foo_1' == 'foo = :foo_1'
+    E         params: {'foo_1': 5} != {'foo_1': 6}
+    ...slowest 2 tests by time spent in alchemy_mock...
+    ...s test_...
+    ...s test_...
+    ...2 failed, 3 passed...
+
+    Invalid ``alchemy_mock_scope`` aborts the whole run::
+
+    >>> code, output = run('-o', 'alchemy_mock_scope=foo')
+    >>> code  # usage error
+    4
+    >>> 'alchemy_mock_scope must be one of function, class, module, package, session' in output
+    True
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import pytest
+
+from .comparison import (
+    ExpressionMatcher,
+    PrettyExpression,
+    compile_expression,
+    get_alchemy_types,
+)
+from .mocking import UnifiedAlchemyMagicMock
+from .utils import match_type, stopwatch
+
+
+SCOPES = ("function", "class", "module", "package", "session")
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("alchemy-mock")
+    group.addoption(
+        "--alchemy-mock-durations",
+        action="store",
+        type=int,
+        default=None,
+        metavar="N",
+        help="show N slowest tests by time spent within alchemy_mock "
+        "(N=0 for all).",
+    )
+    parser.addini(
+        "alchemy_mock_scope",
+        default="function",
+        help="scope in which alchemy_session fixture is shared. "
+        "Data is still restored after each test. "
+        "One of {}.".format(", ".join(SCOPES)),
+    )
+
+
+def pytest_configure(config):
+    if config.getini("alchemy_mock_scope") not in SCOPES:
+        raise pytest.UsageError(
+            "alchemy_mock_scope must be one of {}".format(", ".join(SCOPES))
+        )
+
+    durations = config.getoption("alchemy_mock_durations")
+    if durations is not None:
+        config.pluginmanager.register(
+            AlchemyDurations(durations), "alchemy_mock_durations"
+        )
+
+
+def pytest_assertrepr_compare(config, op, left, right):
+    if op != "==" or not isinstance(left, ExpressionMatcher):
+        return None
+
+    expr = left.expr
+    if not isinstance(expr, get_alchemy_types()) or type(expr) is not type(
+        right
+    ):
+        return None
+
+    left_sql, left_params = compile_expression(expr)
+    right_sql, right_params = compile_expression(right)
+
+    return [
+        "{}(...) == {}(...)".format(type(left).__name__, type(right).__name__),
+        "SQL: {!r} {} {!r}".format(
+            match_type(left_sql, str),
+            "==" if left_sql == right_sql else "!=",
+            match_type(right_sql, str),
+        ),
+        "params: {!r} {} {!r}".format(
+            PrettyExpression(left_params),
+            "==" if left_params == right_params else "!=",
+            PrettyExpression(right_params),
+        ),
+    ]
+
+
+class AlchemyDurations(object):
+    """
+    Plugin which collects time spent within alchemy_mock per test
+    """
+
+    def __init__(self, count):
+        self.count = count
+        self.durations = {}
+
+    def pytest_sessionstart(self, session):
+        stopwatch.enabled = True
+
+    def pytest_sessionfinish(self, session):
+        stopwatch.enabled = False
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_protocol(self, item, nextitem):
+        stopwatch.reset()
+        yield
+        self.durations[item.nodeid] = stopwatch.reset()
+
+    def pytest_terminal_summary(self, terminalreporter):
+        durations = sorted(
+            self.durations.items(), key=lambda i: i[1], reverse=True
+        )
+        if self.count:
+            durations = durations[: self.count]
+
+        terminalreporter.write_sep(
+            "=",
+            "slowest {}tests by time spent in alchemy_mock".format(
+                "{} ".format(self.count) if self.count else ""
+            ),
+        )
+        for nodeid, duration in durations:
+            terminalreporter.write_line("{:.4f}s {}".format(duration, nodeid))
+
+
+@pytest.fixture(scope="session")
+def alchemy_mock_data():
+    """
+    Data given to ``alchemy_session``
+
+    Override this fixture to provide data. Note that its scope
+    cannot be narrower than ``alchemy_mock_scope``.
+    """
+    return None
+
+
+def _make_session_fixture(scope):
+    @pytest.fixture(scope=scope, name="_alchemy_session_{}".format(scope))
+    def fixture(alchemy_mock_data):
+        return UnifiedAlchemyMagicMock(data=alchemy_mock_data)
+
+    return fixture
+
+
+globals().update(
+    ("_alchemy_session_{}".format(i), _make_session_fixture(i)) for i in SCOPES
+)
+
+
+@pytest.fixture
+def alchemy_session(request):
+    """
+    ``UnifiedAlchemyMagicMock`` session with data from ``alchemy_mock_data``
+
+    Session is shared within ``alchemy_mock_scope`` however all mutations
+    done within a test are rolled back after the test.
+    """
+    scope = request.config.getini("alchemy_mock_scope")
+    session = request.getfixturevalue("_alchemy_session_{}".format(scope))
+    with session._mock_store.snapshot():
+        yield session
+        # discards pending transaction as well as pending fallback data
+        session.rollback()
+
+    # fallback database only ever contains data added within a test
+    # so next test simply gets a new one
+    session._mock_fallback_session = None
+    session.reset_mock()
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+from functools import partial
+
+from sqlalchemy.ext import serializer
+
+from .compat import mock
+from .mocking import UnifiedAlchemyMagicMock, sqlalchemy_call
+from .utils import create_sqlite_session, indexof
+
+
+Call = type(mock.call)
+
+
+class RecordingQuery(object):
+    """
+    Proxy around real SQLAlchemy ``Query`` which tracks all calls
+    ``UnifiedAlchemyMagicMock`` unifies and records result-sets
+    in ``AlchemyRecorder`` when query is evaluated.
+
+    Calls which are neither unified nor boundaries are proxied as-is
+    to the underlying query and are therefore not recorded.
+    """
+
+    __slots__ = ["_recorder", "_query", "_calls"]
+
+    def __init__(self, recorder, query, calls):
+        self._recorder = recorder
+        self._query = query
+        self._calls = calls
+
+    def __getattr__(self, name):
+        if name in UnifiedAlchemyMagicMock.unify:
+            return partial(self._unify, name)
+        # exists() is a clause used within outer query chain
+        if name == "exists":
+            return self._exists
+        if name in UnifiedAlchemyMagicMock.boundary:
+            return partial(self._boundary, name)
+        return getattr(self._query, name)
+
+    def __iter__(self):
+        return self._boundary("__iter__")
+
+    def _unify(self, name, *args, **kwargs):
+        query = getattr(self._query, name)(*args, **kwargs)
+        return type(self)(
+            self._recorder, query, self._calls + [(name, args, kwargs)]
+        )
+
+    def _exists(self):
+        # mock evaluates exists() over rows of the query chain
+        # hence they are recorded while real clause is returned
+        self._recorder.record(self._calls, self._query.all())
+        return self._query.exists()
+
+    def _boundary(self, name, *args, **kwargs):
+        if name == "get":
+            instance = self._query.get(*args, **kwargs)
+            if instance is not None:
+                self._recorder.record(
+                    [c for c in self._calls if c[0] == "query"],
+                    [instance],
+                    accumulate=True,
+                )
+            return instance
+
+        rows = self._query.all()
+        self._recorder.record(self._calls, rows)
+        if name in ("all", "__iter__"):
+            return UnifiedAlchemyMagicMock.boundary[name](rows)
+        # code under test gets whatever real query returns
+        return getattr(self._query, name)(*args, **kwargs)
+
+
+class AlchemyRecorder(object):
+    """
+    Recorder of real session traffic into mock data spec
+    which can be replayed with ``UnifiedAlchemyMagicMock``.
+
+    Recorder wraps real session (by default bound to in-memory SQLite engine
+    created from given metadata) and records every evaluated query chain
+    with its result-set. Query calls are unified exactly like
+    ``UnifiedAlchemyMagicMock`` unifies them so recorded criteria
+    match the same query chains during replay.
+
+    For example::
+
+        >>> from sqlalchemy import Column, Integer, String
+        >>> from sqlalchemy.ext.declarative import declarative_base
+
+        >>> Base = declarative_base()
+
+        >>> class SomeClass(Base):
+        ...     __tablename__ = 'some_table'
+        ...     pk1 = Column(Integer, primary_key=True)
+        ...     pk2 = Column(Integer, primary_key=True)
+        ...     name =  Column(String(50))
+        ...     def __repr__(self):
+        ...         return str(self.pk1)
+
+        >>> recorder = AlchemyRecorder(Base.metadata)
+        >>> recorder.add_all([
+        ...     SomeClass(pk1=1, pk2=1, name='one'),
+        ...     SomeClass(pk1=2, pk2=2, name='two'),
+        ... ])
+        >>> recorder.commit()
+
+        >>> q = recorder.query(SomeClass).filter(SomeClass.pk1 > 0)
+        >>> q.filter(SomeClass.name == 'two').all()
+        [2]
+        >>> q.order_by(SomeClass.pk1.desc()).first()
+        2
+        >>> recorder.query(SomeClass).get((1, 1))
+        1
+        >>> list(q.filter(SomeClass.name == 'two'))
+        [2]
+        >>> recorder.query(SomeClass).get((2, 2))
+        2
+
+    Calls which are not unified are proxied to the real query as-is::
+
+        >>> q.session is recorder.session
+        True
+
+    Each query chain is recorded once::
+
+        >>> for criteria, result in recorder.data:
+        ...     print([c[0] for c in criteria], result)
+        ['query', 'filter'] [2]
+        ['query', 'filter', 'order_by'] [2, 1]
+        ['query'] [1, 2]
+
+    Recorded data can then be replayed at mock speed::
+
+        >>> s = UnifiedAlchemyMagicMock(data=recorder.data)
+        >>> s.query(SomeClass).filter(SomeClass.name == 'two').filter(SomeClass.pk1 > 0).all()
+        [2]
+        >>> s.query(SomeClass).filter(SomeClass.pk1 > 0).order_by(SomeClass.pk1.desc()).all()
+        [2, 1]
+        >>> s.query(SomeClass).get((1, 1))
+        1
+
+    ``exists()`` returns real clause for the outer query chain
+    while rows of its own query chain are recorded
+    so that replayed ``exists()`` is evaluated over them::
+
+        >>> q = recorder.query(SomeClass).filter(SomeClass.name == 'one')
+        >>> recorder.query(q.exists()).scalar()
+        True
+        >>> s = UnifiedAlchemyMagicMock(data=recorder.data)
+        >>> s.query(s.query(SomeClass).filter(SomeClass.name == 'one').exists()).scalar()
+        True
+
+    Other boundaries than ``all()`` return what the real query returns
+    while all rows of the query are recorded::
+
+        >>> from sqlalchemy.orm import aliased
+        >>> other = aliased(SomeClass)
+        >>> recorder.query(SomeClass).join(other, other.pk1 > 0).count()
+        4
+
+    When same query chain is recorded again, latest result-set wins
+    while ``get()`` only adds instances to it::
+
+        >>> recorder.delete(recorder.query(SomeClass).get((1, 1)))
+        >>> recorder.commit()
+        >>> recorder.query(SomeClass).all()
+        [2]
+        >>> UnifiedAlchemyMagicMock(data=recorder.data).query(SomeClass).all()
+        [2]
+
+    Recorded data can also be written to a file with :meth:`dump`
+    and read back with :func:`load`. Note that since data is pickled,
+    all models referenced by recorded data must be importable::
+
+        >>> import io
+        >>> table = SomeClass.__table__
+        >>> recorder = AlchemyRecorder(Base.metadata)
+        >>> recorder.add(SomeClass(pk1=1, pk2=1, name='one'))
+        >>> recorder.query(table.c.name).filter(table.c.pk1 == 1).all()
+        [('one',)]
+
+        >>> fid = io.BytesIO()
+        >>> recorder.dump(fid)
+        >>> _ = fid.seek(0)
+        >>> s = UnifiedAlchemyMagicMock(data=load(fid, Base.metadata))
+        >>> s.query(table.c.name).filter(table.c.pk1 == 1).all()
+        [('one',)]
+        >>> s.query(table.c.name).filter(table.c.pk1 == 2).all()
+        []
+    """
+
+    def __init__(self, metadata=None, session=None):
+        if session is None:
+            session = create_sqlite_session(metadata)
+        self.session = session
+        self.data = []
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    def query(self, *args, **kwargs):
+        return RecordingQuery(
+            self,
+            self.session.query(*args, **kwargs),
+            [("query", args, kwargs)],
+        )
+
+    def record(self, calls, result, accumulate=False):
+        """
+        Record result-set for given query calls
+
+        Calls are unified the same way ``UnifiedAlchemyMagicMock`` unifies them.
+        When same criteria is recorded multiple times, latest result wins
+        unless ``accumulate`` is given, as for ``get()`` results, in which case
+        instances missing in the recorded result-set are added to it.
+        """
+        criteria = unify_calls(calls)
+        matchers = [
+            sqlalchemy_call(i, with_name=True, base_call=_call_type(i))
+            for i in criteria
+        ]
+
+        for existing_criteria, existing_result in self.data:
+            if len(existing_criteria) == len(matchers) and all(
+                c in matchers for c in existing_criteria
+            ):
+                if accumulate:
+                    for i in result:
+                        try:
+                            indexof(i, existing_result)
+                        except ValueError:
+                            existing_result.append(i)
+                else:
+                    existing_result[:] = result
+                return
+
+        self.data.append((criteria, list(result)))
+
+    def dump(self, fid):
+        """
+        Write recorded data to a file-like object
+        """
+        fid.write(
+            serializer.dumps(
+                [
+                    ([tuple(c) for c in criteria], result)
+                    for criteria, result in self.data
+                ]
+            )
+        )
+
+
+def unify_calls(calls):
+    """
+    Unify list of ``(name, args, kwargs)`` calls into list of ``mock.call``
+    similar to how ``UnifiedAlchemyMagicMock`` unifies calls within a query
+
+    For example::
+
+        >>> unify_calls([
+        ...     ('query', ('foo',), {}),
+        ...     ('filter', (1,), {}),
+        ...     ('filter', (2,), {}),
+        ... ])
+        [call.query('foo'), call.filter(1, 2)]
+    """
+    unified = []
+
+    for name, args, kwargs in calls:
+        previous = next((i for i in unified if i[0] == name), None)
+        if previous is not None:
+            _, pargs, pkwargs = unified.pop(indexof(previous, unified))
+            args = pargs + tuple(args)
+            kwargs = dict(pkwargs, **kwargs)
+        unified.append((name, tuple(args), kwargs))
+
+    return [Call(i) for i in unified]
+
+
+def load(fid, metadata=None, scoped_session=None):
+    """
+    Load data recorded by :meth:`AlchemyRecorder.dump`
+    which can be given to ``UnifiedAlchemyMagicMock(data=...)``
+    """
+    data = serializer.loads(fid.read(), metadata, scoped_session)
+    return [([Call(c) for c in criteria], result) for criteria, result in data]
+
+
+def _call_type(call):
+    return UnifiedAlchemyMagicMock.unify.get(call[0]) or Call
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+"""
+Resolution of relationships over objects stored in mock data
+
+Relationships are resolved by their mapper metadata. Related objects
+are looked up by values of foreign key columns in an index which
+is built once per relationship hence resolving relationships
+of ``N`` objects costs ``O(N)``. Only relationships
+without a ``secondary`` table can be resolved.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import six
+
+from .compact import CompactRows, FilteredRows, is_instance, materialize
+
+
+# loader strategies which load relationships together with the query
+EAGER_STRATEGIES = {"joined", "selectin", "subquery", "immediate"}
+
+
+def get_query_mapper(calls):
+    """
+    Get mapper of the model queried by given query calls
+    or ``None`` when query is not for a single model
+    """
+    from sqlalchemy import inspect
+
+    query_call = next((i for i in calls if i[0] == "query"), None)
+    if query_call is None or len(query_call[1]) != 1:
+        return None
+
+    model = query_call[1][0]
+    if not isinstance(model, type):
+        return None
+    return inspect(model, raiseerr=False)
+
+
+def get_relationship_path(mapper, path):
+    """
+    Get list of relationship properties described by given path
+    of relationship attributes, their names or mapped classes
+    starting from given mapper
+
+    Returns ``None`` when path cannot be resolved.
+
+    For example::
+
+        >>> from sqlalchemy import Column, ForeignKey, Integer, inspect
+        >>> from sqlalchemy.ext.declarative import declarative_base
+        >>> from sqlalchemy.orm import relationship
+
+        >>> Base = declarative_base()
+
+        >>> class Parent(Base):
+        ...     __tablename__ = 'parent'
+        ...     id = Column(Integer, primary_key=True)
+        ...     children = relationship('Child', backref='parent')
+
+        >>> class Child(Base):
+        ...     __tablename__ = 'child'
+        ...     id = Column(Integer, primary_key=True)
+        ...     parent_id = Column(ForeignKey('parent.id'))
+
+        >>> mapper = inspect(Parent)
+        >>> [i.key for i in get_relationship_path(mapper, [Parent.children, 'parent'])]
+        ['children', 'parent']
+        >>> [i.key for i in get_relationship_path(mapper, [Child])]
+        ['children']
+        >>> get_relationship_path(mapper, [Parent.id])
+        >>> get_relationship_path(mapper, ['foo'])
+        >>> get_relationship_path(mapper, [Parent])
+        >>> get_relationship_path(mapper, [Parent.id == Child.parent_id])
+    """
+    from sqlalchemy.orm import RelationshipProperty
+
+    props = []
+
+    for token in path:
+        if isinstance(token, six.string_types):
+            prop = mapper.relationships.get(token)
+
+        elif isinstance(token, type):
+            related = [
+                i for i in mapper.relationships if i.mapper.class_ is token
+            ]
+            prop = related[0] if len(related) == 1 else None
+
+        else:
+            prop = getattr(token, "property", None)
+
+        if (
+            not isinstance(prop, RelationshipProperty)
+            or prop.secondary is not None
+        ):
+            return None
+
+        props.append(prop)
+        mapper = prop.mapper
+
+    return props
+
+
+def get_related(store, prop, instance):
+    """
+    Get list of stored instances related to given instance
+
+    Rows of :class:`~alchemy_mock.compact.CompactRows` are returned
+    as their handles.
+    """
+    key = tuple(
+        getattr(instance, prop.parent.get_property_by_column(local).key)
+        for local, _ in prop.local_remote_pairs
+    )
+    return store.relationship_index(prop).get(key, [])
+
+
+def load_relationship(store, prop, instances):
+    """
+    Populate relationship on all given instances with related
+    stored instances and return all related instances
+    """
+    from sqlalchemy.orm.attributes import set_committed_value
+
+    loaded = []
+    seen = set()
+
+    for instance in instances:
+        if not isinstance(instance, prop.parent.class_):
+            continue
+
+        related = [materialize(i) for i in get_related(store, prop, instance)]
+        set_committed_value(
+            instance,
+            prop.key,
+            list(related) if prop.uselist else next(iter(related), None),
+        )
+
+        for i in related:
+            if id(i) not in seen:
+                seen.add(id(i))
+                loaded.append(i)
+
+    return loaded
+
+
+def has_related(store, props, instance):
+    """
+    Check whether given instance can be joined with stored instances
+    along all given relationships
+
+    Each relationship is joined from all already joined instances
+    of its parent model.
+    """
+    joined = [instance]
+    for prop in props:
+        related = [
+            j
+            for i in joined
+            if is_instance(i, prop.parent.class_)
+            for j in get_related(store, prop, i)
+        ]
+        if not related:
+            return False
+        joined.extend(related)
+    return True
+
+
+def resolve_relationships(store, calls, result, skip=()):
+    """
+    Resolve ``join`` and ``options`` query calls over stored instances
+
+    Joins along relationships only keep instances which have related
+    instances while eager loading options such as ``joinedload``
+    populate relationships of loaded instances.
+    Calls whose names are in ``skip`` are left as plain criteria.
+
+    For example::
+
+        >>> from sqlalchemy import Column, ForeignKey, Integer, String
+        >>> from sqlalchemy.ext.declarative import declarative_base
+        >>> from sqlalchemy.orm import joinedload, relationship
+        >>> from alchemy_mock.store import JournaledStore
+
+        >>> Base = declarative_base()
+
+        >>> class Parent(Base):
+        ...     __tablename__ = 'parent'
+        ...     id = Column(Integer, primary_key=True)
+        ...     children = relationship('Child')
+        ...     def __repr__(self):
+        ...         return 'Parent({})'.format(self.id)
+
+        >>> class Child(Base):
+        ...     __tablename__ = 'child'
+        ...     id = Column(Integer, primary_key=True)
+        ...     parent_id = Column(ForeignKey('parent.id'))
+        ...     def __repr__(self):
+        ...         return 'Child({})'.format(self.id)
+
+        >>> store = JournaledStore()
+        >>> parents = [Parent(id=1), Parent(id=2)]
+        >>> store.add(Child(id=1, parent_id=1))
+        >>> store.add(Child(id=2, parent_id=1))
+        >>> calls = [
+        ...     ('query', (Parent,), {}),
+        ...     ('join', (Parent.children,), {}),
+        ...     ('options', (joinedload(Parent.children),), {}),
+        ... ]
+        >>> resolve_relationships(store, calls, parents)
+        [Parent(1)]
+        >>> vars(parents[0])['children']
+        [Child(1), Child(2)]
+        >>> resolve_relationships(store, calls, parents, skip={'join', 'options'})
+        [Parent(1), Parent(2)]
+        >>> resolve_relationships(store, [('query', ('foo',), {})], parents)
+        [Parent(1), Parent(2)]
+        >>> resolve_relationships(store, [], parents)
+        [Parent(1), Parent(2)]
+
+    Compact rows are joined via their handles so that only joined
+    instances are built::
+
+        >>> from alchemy_mock.compact import CompactRows
+        >>> rows = CompactRows(Parent, id=[1, 2])
+        >>> joined = resolve_relationships(store, calls[:2], rows)
+        >>> joined, len(rows.instances)
+        ([Parent(1)], 1)
+        >>> list(resolve_relationships(store, calls[::2], rows))
+        [Parent(1), Parent(2)]
+
+    Related instances stored as compact rows are only built once loaded::
+
+        >>> from alchemy_mock.compat import mock
+        >>> store = JournaledStore([
+        ...     ([mock.call.query(Child)], CompactRows(Child, id=[3], parent_id=[2])),
+        ... ])
+        >>> resolve_relationships(store, calls, parents)
+        [Parent(2)]
+        >>> vars(parents[1])['children']
+        [Child(3)]
+
+    Relationships of compact rows are only loaded for returned instances::
+
+        >>> rows = CompactRows(Parent, id=[1, 2])
+        >>> loaded = resolve_relationships(store, calls[::2], rows)
+        >>> len(loaded), len(rows.instances)
+        (2, 0)
+        >>> loaded[1], vars(loaded[1])['children']
+        (Parent(2), [Child(3)])
+
+    Instances which are not of the relationship parent model are ignored::
+
+        >>> resolve_relationships(store, calls[::2], ['foo', Parent(id=1)])
+        ['foo', Parent(1)]
+    """
+    mapper = get_query_mapper(calls)
+    if mapper is None:
+        return result
+
+    paths = []
+    for name, args, _ in calls:
+        if name in skip:
+            continue
+
+        if name == "join":
+            props = get_relationship_path(mapper, args)
+            # joins on explicit conditions are only used as criteria
+            if props is not None:
+                rows = (
+                    result.handles()
+                    if isinstance(result, CompactRows)
+                    else result
+                )
+                result = [
+                    materialize(i) for i in rows if has_related(store, props, i)
+                ]
+
+        elif name == "options":
+            paths.extend(
+                get_relationship_path(mapper, j) or []
+                for i in args
+                for j in _get_eager_paths(i)
+            )
+
+    if not paths:
+        return result
+    # loaded relationships are only kept on built instances
+    # hence they are loaded once compact rows are returned
+    if isinstance(result, CompactRows):
+        return FilteredRows(
+            result, loader=lambda i: load_paths(store, paths, [i])
+        )
+    load_paths(store, paths, result)
+    return result
+
+
+def load_paths(store, paths, instances):
+    """
+    Populate all relationships along given paths of relationship
+    properties on given instances
+    """
+    for path in paths:
+        loaded = instances
+        for prop in path:
+            loaded = load_relationship(store, prop, loaded)
+
+
+def _get_eager_paths(option):
+    """
+    Get relationship paths eagerly loaded by given query option
+
+    For example::
+
+        >>> from sqlalchemy import Column, ForeignKey, Integer
+        >>> from sqlalchemy.ext.declarative import declarative_base
+        >>> from sqlalchemy.orm import Load, defer, relationship
+
+        >>> Base = declarative_base()
+
+        >>> class Parent(Base):
+        ...     __tablename__ = 'parent'
+        ...     id = Column(Integer, primary_key=True)
+        ...     children = relationship('Child', backref='parent')
+
+        >>> class Child(Base):
+        ...     __tablename__ = 'child'
+        ...     id = Column(Integer, primary_key=True)
+        ...     parent_id = Column(ForeignKey('parent.id'))
+
+        >>> _get_eager_paths(Load(Parent).joinedload('children').selectinload('parent'))
+        [['children'], ['children', 'parent']]
+        >>> _get_eager_paths(defer(Parent.id)), _get_eager_paths('foo')
+        ([], [])
+
+    Loader options which cannot be introspected are not silently ignored::
+
+        >>> option = Load(Parent)
+        >>> option.context = None
+        >>> _get_eager_paths(option)
+        Traceback (most recent call last):
+        ...
+        TypeError: Cannot resolve loader paths of <...Load object at ...>
+    """
+    from sqlalchemy.orm import Load
+
+    # other options such as caching options do not load anything
+    if not isinstance(option, Load):
+        return []
+
+    # unbound loader options such as joinedload(...) keep all their
+    # loader paths in _to_bind while bound Load(...) options keep them
+    # in their context keyed by alternating mappers and properties
+    if hasattr(option, "_to_bind"):
+        loads = [(i.path, i.strategy) for i in option._to_bind]
+    elif isinstance(getattr(option, "context", None), dict):
+        loads = sorted(
+            (
+                ([i.key for i in path[1::2]], load.strategy)
+                for (kind, path), load in option.context.items()
+                if kind == "loader"
+            ),
+            key=lambda i: len(i[0]),
+        )
+    else:
+        raise TypeError("Cannot resolve loader paths of {!r}".format(option))
+
+    return [
+        path
+        for path, strategy in loads
+        if dict(strategy or ()).get("lazy") in EAGER_STRATEGIES
+    ]
@@ -0,0 +1,707 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+from contextlib import contextmanager
+
+from .compact import CompactRows, FilteredRows, RowHandle, is_instance
+from .compat import mock
+from .matching import is_factory
+from .utils import LRUCache, get_primary_key, indexof
+
+
+class JournaledStore(object):
+    """
+    Mock data store which journals all mutations in an undo log.
+
+    Since only undo operations are journaled, savepoints are simply positions
+    in the journal and rolling back to a savepoint only undoes mutations done
+    after the savepoint without ever copying stored data.
+
+    For example::
+
+        >>> from sqlalchemy import Column, Integer, String
+        >>> from sqlalchemy.ext.declarative import declarative_base
+
+        >>> Base = declarative_base()
+
+        >>> class SomeClass(Base):
+        ...     __tablename__ = 'some_table'
+        ...     pk1 = Column(Integer, primary_key=True)
+        ...     pk2 = Column(Integer, primary_key=True)
+        ...     name =  Column(String(50))
+        ...     def __repr__(self):
+        ...         return '{}:{}'.format(self.pk1, self.name)
+
+        >>> one = SomeClass(pk1=1, pk2=1, name='one')
+        >>> store = JournaledStore([
+        ...     ([mock.call.filter(SomeClass.name == 'one')], [one]),
+        ... ])
+        >>> store.add(one)
+        >>> store.add(SomeClass(pk1=2, pk2=2, name='two'))
+        >>> store.commit()
+        >>> [result for _, result in store.data]
+        [[1:one], [1:one, 2:two]]
+
+    Deletes remove instance from all result-sets::
+
+        >>> store.delete(one)
+        >>> [result for _, result in store.data]
+        [[], [2:two]]
+
+    Merges update already stored instance with the same identity::
+
+        >>> sp = store.savepoint()
+        >>> store.merge(SomeClass(pk1=2, pk2=2, name='dos'))
+        2:dos
+        >>> store.merge(SomeClass(pk1=3, pk2=3, name='three'))
+        3:three
+        >>> [result for _, result in store.data]
+        [[], [2:dos, 3:three]]
+        >>> store.delete(store.identity_map[(SomeClass, (3, 3))])
+        >>> [result for _, result in store.data]
+        [[], [2:dos]]
+
+    All of which can be rolled back either to a savepoint
+    or to the last commit::
+
+        >>> store.rollback(sp)
+        >>> [result for _, result in store.data]
+        [[], [2:two]]
+        >>> store.rollback()
+        >>> [result for _, result in store.data]
+        [[1:one], [1:one, 2:two]]
+    """
+
+    def __init__(self, data=None, cache_size=128):
+        self.data = data if data is not None else []
+        # cache of matched data which is cleared on any mutation
+        self.cache = LRUCache(cache_size)
+        # precompiled index of data criteria which is reset
+        # whenever entries are added to or removed from data
+        self.index = None
+        self.journal = []
+        self._models = None
+        self._relationships = {}
+        self._committed = 0
+        self._snapshots = 0
+        self._identity_map = None
+
+    @property
+    def identity_map(self):
+        """
+        Identity map of all stored model instances
+        keyed by ``(model, primary key)``
+
+        Rows of :class:`CompactRows` are not part of the identity map
+        since their instances are built lazily. Use :meth:`get_identity`
+        to look up instances in all result-sets.
+        """
+        if self._identity_map is None:
+            self._identity_map = {}
+            for _, result in self.data:
+                if is_factory(result) or isinstance(result, CompactRows):
+                    continue
+                for i in result:
+                    if _is_mapped(i):
+                        self._identity_map[identity_key(i)] = i
+        return self._identity_map
+
+    def get_identity(self, key):
+        """
+        Get stored instance by its ``(model, primary key)`` identity key
+        or ``None`` when there is no such instance
+
+        Instances found in :class:`CompactRows` are pinned
+        so that any changes done to them are kept.
+
+        For example::
+
+            >>> from sqlalchemy import Column, Integer
+            >>> from sqlalchemy.ext.declarative import declarative_base
+
+            >>> Base = declarative_base()
+
+            >>> class SomeClass(Base):
+            ...     __tablename__ = 'some_table'
+            ...     pk1 = Column(Integer, primary_key=True)
+            ...     def __repr__(self):
+            ...         return str(self.pk1)
+
+            >>> rows = CompactRows(SomeClass, pk1=[2, 3])
+            >>> store = JournaledStore([
+            ...     ([mock.call.query(SomeClass)], [SomeClass(pk1=1)]),
+            ...     ([mock.call.query(int)], CompactRows(int)),
+            ...     ([mock.call.filter(SomeClass.pk1 > 1)], rows),
+            ... ])
+            >>> store.get_identity((SomeClass, (1,)))
+            1
+            >>> store.get_identity((SomeClass, (3,)))
+            3
+            >>> rows.pinned
+            {1: 3}
+            >>> store.get_identity((SomeClass, (4,)))
+        """
+        existing = self.identity_map.get(key)
+        if existing is not None:
+            return existing
+
+        model, ident = key
+        for _, result in self.data:
+            if isinstance(result, CompactRows) and result.model is model:
+                existing = result.get(ident)
+                if existing is not None:
+                    result.pin(existing)
+                    return existing
+
+        return None
+
+    def savepoint(self):
+        """
+        Get savepoint which can be rolled back to with :meth:`rollback`
+        """
+        return len(self.journal)
+
+    def flush(self):
+        """
+        Write changes of instances built from :class:`CompactRows`
+        back to their columns and reset everything derived
+        from stored instances since they might have been changed directly
+        """
+        for rows in self._compact_rows():
+            for index, key, value in list(rows.changes()):
+                self._set_value(rows, index, key, value)
+            rows.release()
+        self._identity_map = None
+        self._relationships.clear()
+        self.cache.clear()
+
+    def commit(self):
+        """
+        Make all mutations permanent
+
+        Within :meth:`snapshot` commits are only remembered
+        so that the snapshot can still be restored.
+        """
+        self.flush()
+        if self._snapshots:
+            self._committed = len(self.journal)
+        else:
+            del self.journal[:]
+            self._committed = 0
+
+    def rollback(self, savepoint=None):
+        """
+        Undo all mutations since given savepoint
+        or since last commit when savepoint is not provided
+        """
+        if savepoint is None:
+            savepoint = self._committed
+        while len(self.journal) > savepoint:
+            undo, args = self.journal.pop()
+            undo(*args)
+        self._committed = min(self._committed, savepoint)
+        # built instances might have been changed without being flushed
+        for rows in self._compact_rows():
+            rows.expire()
+        self._identity_map = None
+        self._models = None
+        self._relationships.clear()
+        self.index = None
+        self.cache.clear()
+
+    @contextmanager
+    def snapshot(self):
+        """
+        Context manager which restores all data as it was before the block
+        even if mutations were committed within the block
+
+        For example::
+
+            >>> store = JournaledStore([([], [])])
+            >>> with store.snapshot():
+            ...     store._insert(store.data[0][1], 0, 'foo')
+            ...     store.commit()
+            ...     store._insert(store.data[0][1], 0, 'bar')
+            ...     store.rollback()
+            ...     print(store.data)
+            [([], ['foo'])]
+            >>> store.data
+            [([], [])]
+        """
+        savepoint = self.savepoint()
+        self._snapshots += 1
+        try:
+            yield
+        finally:
+            self._snapshots -= 1
+            self.rollback(savepoint)
+
+    def add(self, instance):
+        """
+        Add instance to the result-set of ``query(Model)``
+        """
+        result = self.model_result(type(instance))
+
+        if result is not None:
+            self._insert(result, len(result), instance)
+        else:
+            self._insert(
+                self.data,
+                len(self.data),
+                ([mock.call.query(type(instance))], [instance]),
+            )
+
+        if self._identity_map is not None:
+            self._identity_map[identity_key(instance)] = instance
+
+    def model_result(self, model):
+        """
+        Get result-set of ``[query(Model)]`` entry which instances
+        of the model are added to or ``None`` when there is no such entry
+
+        Entries are indexed by model on first use so that adding
+        instances does not need to scan all data.
+
+        For example::
+
+            >>> store = JournaledStore([
+            ...     ([mock.call.query(int)], lambda: [0]),
+            ...     ([mock.call.query(int), mock.call.filter(1)], [1]),
+            ...     ([mock.call.query('foo')], ['foo']),
+            ...     ([mock.call.query(int)], [2]),
+            ... ])
+            >>> store.model_result(int)
+            [2]
+            >>> store.model_result(str)
+        """
+        if self._models is None:
+            self._models = {}
+            for criteria, result in self.data:
+                if len(criteria) != 1 or is_factory(result):
+                    continue
+                name, args, kwargs = criteria[0]
+                if (
+                    name == "query"
+                    and len(args) == 1
+                    and isinstance(args[0], type)
+                    and not kwargs
+                ):
+                    self._models.setdefault(args[0], result)
+        return self._models.get(model)
+
+    def relationship_index(self, prop):
+        """
+        Get index of stored instances which can be related via given
+        relationship property keyed by values of their columns
+        referenced by the relationship
+
+        Index is built once per relationship and is reset on any mutation.
+
+        For example::
+
+            >>> from sqlalchemy import Column, ForeignKey, Integer
+            >>> from sqlalchemy.ext.declarative import declarative_base
+            >>> from sqlalchemy.orm import relationship
+
+            >>> Base = declarative_base()
+
+            >>> class Parent(Base):
+            ...     __tablename__ = 'parent'
+            ...     id = Column(Integer, primary_key=True)
+            ...     children = relationship('Child')
+
+            >>> class Child(Base):
+            ...     __tablename__ = 'child'
+            ...     id = Column(Integer, primary_key=True)
+            ...     parent_id = Column(ForeignKey('parent.id'))
+            ...     def __repr__(self):
+            ...         return str(self.id)
+
+            >>> store = JournaledStore()
+            >>> for i in range(4):
+            ...     store.add(Child(id=i, parent_id=i % 2))
+            >>> store.add(Child(id=4))
+            >>> index = store.relationship_index(Parent.children.property)
+            >>> sorted(index.items())
+            [((0,), [0, 2]), ((1,), [1, 3])]
+            >>> store.relationship_index(Parent.children.property) is index
+            True
+        """
+        if prop not in self._relationships:
+            keys = [
+                prop.mapper.get_property_by_column(remote).key
+                for _, remote in prop.local_remote_pairs
+            ]
+            index = {}
+            seen = set()
+
+            for _, result in self.data:
+                if is_factory(result):
+                    continue
+                # compact rows are indexed by their handles
+                # so that related instances are only built when loaded
+                if isinstance(result, CompactRows):
+                    result = result.handles()
+                for i in result:
+                    if not is_instance(i, prop.mapper.class_):
+                        continue
+                    identity = identity_key(i)
+                    if identity in seen:
+                        continue
+                    seen.add(identity)
+                    key = tuple(getattr(i, k) for k in keys)
+                    if None not in key:
+                        index.setdefault(key, []).append(i)
+
+            self._relationships[prop] = index
+
+        return self._relationships[prop]
+
+    def delete(self, instance):
+        """
+        Remove instance from all result-sets it is part of
+        """
+        for _, result in self.data:
+            if is_factory(result):
+                continue
+            while True:
+                try:
+                    if isinstance(result, CompactRows):
+                        index = result.index(instance)
+                    else:
+                        index = indexof(instance, result)
+                except ValueError:
+                    break
+                self._pop(result, index)
+
+        if self._identity_map is not None:
+            self._identity_map.pop(identity_key(instance), None)
+
+    def merge(self, instance):
+        """
+        Copy state of given instance onto already stored instance
+        with the same identity or add it when there is no such instance
+
+        Returns stored instance.
+        """
+        from sqlalchemy import inspect
+
+        existing = self.get_identity(identity_key(instance))
+
+        if existing is None:
+            self.add(instance)
+            return instance
+
+        for prop in inspect(type(instance)).mapper.column_attrs:
+            if prop.key in vars(instance):
+                self._setattr(existing, prop.key, getattr(instance, prop.key))
+
+        return existing
+
+    def _insert(self, sequence, index, item):
+        sequence.insert(index, item)
+        self.journal.append((sequence.pop, (index,)))
+        self._changed(sequence)
+
+    def _pop(self, sequence, index):
+        item = sequence.pop(index)
+        self.journal.append((sequence.insert, (index, item)))
+        self._changed(sequence)
+
+    def _set_value(self, rows, index, key, value):
+        self.journal.append(
+            (rows.set_value, (index, key, rows.columns[key][index]))
+        )
+        rows.set_value(index, key, value)
+        self._changed(rows)
+
+    def _compact_rows(self):
+        for _, result in self.data:
+            if isinstance(result, CompactRows):
+                yield result
+
+    def _setattr(self, obj, name, value):
+        self.journal.append((setattr, (obj, name, getattr(obj, name))))
+        setattr(obj, name, value)
+        self._changed(obj)
+
+    def _changed(self, changed):
+        if changed is self.data:
+            self._models = None
+            self.index = None
+        self._relationships.clear()
+        self.cache.clear()
+
+
+class SavepointTransaction(object):
+    """
+    Nested transaction as returned by ``session.begin_nested()``
+
+    Optional ``nested`` transaction of fallback database
+    is committed and rolled back together with the store.
+
+    For example::
+
+        >>> store = JournaledStore([([], [])])
+        >>> with SavepointTransaction(store):
+        ...     store._insert(store.data[0][1], 0, 'foo')
+        >>> store.data
+        [([], ['foo'])]
+
+        >>> with SavepointTransaction(store):
+        ...     store._insert(store.data[0][1], 0, 'bar')
+        ...     raise ValueError
+        Traceback (most recent call last):
+        ...
+        ValueError
+        >>> store.data
+        [([], ['foo'])]
+    """
+
+    def __init__(self, store, nested=None):
+        self.store = store
+        self.nested = nested
+        self.savepoint = store.savepoint()
+        self.is_active = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+    def commit(self):
+        if self.is_active and self.nested is not None:
+            self.nested.commit()
+        self.is_active = False
+
+    def rollback(self):
+        if self.is_active:
+            self.store.rollback(self.savepoint)
+            if self.nested is not None:
+                self.nested.rollback()
+        self.is_active = False
+
+
+class PendingTransaction(object):
+    """
+    Uncommitted mutations of a single session which are kept apart
+    from the shared store until they are committed
+
+    Pending mutations are only visible to the session itself via
+    :meth:`view` while other sessions only see committed data.
+
+    For example::
+
+        >>> store = JournaledStore([([mock.call.query(int)], [1, 2])])
+        >>> transaction = PendingTransaction(store)
+        >>> transaction.add(3)
+        >>> transaction.delete(store.data[0][1][0])
+        >>> calls = [('query', (int,), {})]
+        >>> transaction.view(calls, store.model_result(int))
+        [2, 3]
+        >>> transaction.view(calls, None)
+        [3]
+        >>> transaction.view(calls, [5])
+        [5]
+        >>> transaction.view([('query', ('foo',), {})], None)
+        >>> transaction.view(calls, [[1], [4]], get=True)
+        [[], [4], [3]]
+        >>> store.data[0][1]
+        [1, 2]
+
+        >>> transaction.flush()
+        >>> store.data[0][1]
+        [1, 2]
+
+        >>> sp = transaction.savepoint()
+        >>> transaction.add(4)
+        >>> transaction.rollback(sp)
+        >>> transaction.commit()
+        >>> store.data[0][1]
+        [2, 3]
+        >>> transaction.view(calls, store.model_result(int))
+        [2, 3]
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.journal = []
+        # instances replaced by pending merged copies keyed by copy id
+        self.originals = {}
+
+    def savepoint(self):
+        return len(self.journal)
+
+    def commit(self):
+        """
+        Apply all pending mutations to the shared store and commit it
+        """
+        for name, instance in self.journal:
+            if name != "merge":
+                instance = self.originals.get(id(instance), instance)
+            getattr(self.store, name)(instance)
+        del self.journal[:]
+        self.originals.clear()
+        self.store.commit()
+
+    def rollback(self, savepoint=None):
+        if savepoint is None:
+            savepoint = 0
+        del self.journal[savepoint:]
+
+    def flush(self):
+        """
+        Flush shared store since only already stored instances
+        can be changed directly while pending mutations stay pending
+        """
+        self.store.flush()
+
+    def add(self, instance):
+        self.journal.append(("add", instance))
+
+    def delete(self, instance):
+        self.journal.append(("delete", instance))
+
+    def merge(self, instance):
+        """
+        Merge instance on commit
+
+        Since instances in the shared store are visible to other sessions,
+        state is merged into a pending copy of the instance with the same
+        identity which replaces it in :meth:`view` and which is merged
+        into the shared store on commit. Returns the copy.
+        """
+        from sqlalchemy import inspect
+
+        key = identity_key(instance)
+
+        for name, pending in reversed(self.journal):
+            if _is_mapped(pending) and identity_key(pending) == key:
+                existing = pending if name != "delete" else None
+                break
+        else:
+            existing = self.store.get_identity(key)
+
+        if existing is None:
+            self.add(instance)
+            return instance
+
+        mapper = inspect(type(existing)).mapper
+        merged = mapper.class_manager.new_instance()
+        for prop in mapper.column_attrs:
+            source = instance if prop.key in vars(instance) else existing
+            setattr(merged, prop.key, getattr(source, prop.key))
+
+        self.originals[id(merged)] = self.originals.get(id(existing), existing)
+        self.journal.append(("merge", merged))
+        return merged
+
+    def view(self, calls, result, get=False):
+        """
+        Apply pending mutations to result-set matched
+        in the shared store for given query calls
+
+        Similar to :meth:`JournaledStore.add`, pending instances are
+        only part of ``query(Model)`` result-set hence they are only
+        visible when no other entry matched.
+
+        Pending mutations of :class:`CompactRows` are applied
+        by row positions without building any other instances::
+
+            >>> class Row(object):
+            ...     def __init__(self, a):
+            ...         self.a = a
+            ...     def __repr__(self):
+            ...         return str(self.a)
+
+            >>> rows = CompactRows(Row, a=[1, 2, 3])
+            >>> transaction = PendingTransaction(
+            ...     JournaledStore([([mock.call.query(Row)], rows)])
+            ... )
+            >>> transaction.delete(rows[0])
+            >>> transaction.add(Row(4))
+            >>> view = transaction.view([('query', (Row,), {})], rows)
+            >>> len(view), len(rows.instances)
+            (3, 1)
+            >>> list(view)
+            [2, 3, 4]
+            >>> list(transaction.view([('query', (Row,), {})], FilteredRows(rows)))
+            [2, 3, 4]
+        """
+        added, deleted, merged = [], {}, {}
+        for name, instance in self.journal:
+            original = self.originals.get(id(instance), instance)
+            if name == "add":
+                added.append(instance)
+            elif name == "merge":
+                merged[id(original)] = (original, instance)
+            elif name == "delete":
+                merged.pop(id(original), None)
+                try:
+                    added.pop(indexof(original, added))
+                except ValueError:
+                    deleted[id(original)] = original
+
+        if not added and not deleted and not merged:
+            return result
+
+        query_call = next((i for i in calls if i[0] == "query"), None)
+        model = None
+        if (
+            query_call is not None
+            and len(query_call[1]) == 1
+            and isinstance(query_call[1][0], type)
+        ):
+            model = query_call[1][0]
+
+        # eagerly loaded compact rows are still model result-set
+        rows = result.rows if isinstance(result, FilteredRows) else result
+        if not (
+            get or result is None or rows is self.store.model_result(model)
+        ):
+            added = []
+
+        added = [
+            merged[id(i)][1] if id(i) in merged else i
+            for i in added
+            if type(i) is model
+        ]
+        if get:
+            # get looks up identity in all result-sets where
+            # later result-sets take precedence
+            results = [_exclude(r, deleted, merged) for r in result or []]
+            return results + [added]
+        if result is None and not added:
+            return None
+
+        return _exclude(result or [], deleted, merged, added)
+
+
+def _exclude(result, deleted, merged, added=()):
+    if not deleted and not merged and not added:
+        return result
+    # compact rows are filtered lazily so that they are not built
+    if isinstance(result, CompactRows):
+        return FilteredRows(result, deleted.values(), added, merged.values())
+    if isinstance(result, FilteredRows):
+        return result.exclude(deleted.values(), added, merged.values())
+    return [
+        merged[id(i)][1] if id(i) in merged else i
+        for i in result
+        if id(i) not in deleted
+    ] + list(added)
+
+
+def _is_mapped(instance):
+    from sqlalchemy import inspect
+
+    return inspect(type(instance), raiseerr=False) is not None
+
+
+def identity_key(instance):
+    if isinstance(instance, RowHandle):
+        return instance.identity
+    return type(instance), get_primary_key(instance)
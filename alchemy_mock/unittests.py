@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
 
-from .comparison import ALCHEMY_TYPES, ExpressionMatcher, PrettyExpression
+from .comparison import ExpressionMatcher, PrettyExpression, get_alchemy_types
+from .utils import LazyString, stopwatch
 
 
 class AlchemyUnittestMixin(object):
@@ -22,21 +23,38 @@ class AlchemyUnittestMixin(object):
         ...     def test_false(self):
         ...         c = column('column')
         ...         self.assertEqual(c == 5, c == 10)
+        ...     def test_other(self):
+        ...         self.assertEqual(5, 5)
         >>> FooTest('test_true').test_true()
+        >>> FooTest('test_other').test_other()
         >>> FooTest('test_false').test_false()
         Traceback (most recent call last):
         ...
         AssertionError: BinaryExpression(sql='"column" = :column_1', params={'column_1': 5}) != BinaryExpression(sql='"column" = :column_1', params={'column_1': 10})
-    """
 
-    def __init__(self, *args, **kwargs):
-        super(AlchemyUnittestMixin, self).__init__(*args, **kwargs)
+    Failure messages are only rendered when they are displayed
+    so negative checks such as ``assertRaises(AssertionError)``
+    do not pay for compiling expressions::
+
+        >>> try:
+        ...     FooTest('test_false').test_false()
+        ... except AssertionError as e:
+        ...     error = e
+        >>> error.args[0]._value is None
+        True
+    """
 
-        # add sqlalchemy expression type which will allow to
-        # use self.assertEqual
-        for t in ALCHEMY_TYPES:
-            self.addTypeEqualityFunc(t, "assertSQLAlchemyExpressionEqual")
+    def _getAssertEqualityFunc(self, first, second):
+        # use assertSQLAlchemyExpressionEqual in self.assertEqual
+        # for sqlalchemy expression types without having to register
+        # all of them via addTypeEqualityFunc for every test case instance
+        if type(first) is type(second) and type(first) in get_alchemy_types():
+            return self.assertSQLAlchemyExpressionEqual
+        return super(AlchemyUnittestMixin, self)._getAssertEqualityFunc(
+            first, second
+        )
 
+    @stopwatch.timed
     def assertSQLAlchemyExpressionEqual(self, left, right, msg=None):
         """
         Assert that two given sqlalchemy expressions are equal
@@ -45,7 +63,9 @@ class AlchemyUnittestMixin(object):
         if ExpressionMatcher(left) != right:
             raise self.failureException(
                 msg
-                or "{!r} != {!r}".format(
-                    PrettyExpression(left), PrettyExpression(right)
+                or LazyString(
+                    "{!r} != {!r}".format,
+                    PrettyExpression(left),
+                    PrettyExpression(right),
                 )
             )
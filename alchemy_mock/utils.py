@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
+import collections
+import time
+import weakref
 from contextlib import contextmanager
+from functools import partial, wraps
 
 import six
-from sqlalchemy import inspect
 
 
 def match_type(s, t):
@@ -141,14 +144,267 @@ def build_identity_map(items):
         >>> build_identity_map([SomeClass(pk1=1, pk2=2)])
         {(1, 2): 1}
     """
-    idmap = {}
+    return {get_primary_key(i): i for i in items}
 
-    for i in items:
-        mapper = inspect(type(i)).mapper
-        pk_keys = tuple(
-            mapper.get_property_by_column(c).key for c in mapper.primary_key
-        )
-        pk = tuple(getattr(i, k) for k in pk_keys)
-        idmap[pk] = i
 
-    return idmap
+def get_primary_key(instance):
+    """
+    Utility for getting primary key tuple of given sqlalchemy model instance
+
+    For example::
+
+        >>> from sqlalchemy import Column, Integer
+        >>> from sqlalchemy.ext.declarative import declarative_base
+
+        >>> Base = declarative_base()
+
+        >>> class SomeClass(Base):
+        ...     __tablename__ = 'some_table'
+        ...     pk1 = Column(Integer, primary_key=True)
+        ...     pk2 = Column(Integer, primary_key=True)
+
+        >>> get_primary_key(SomeClass(pk1=1, pk2=2))
+        (1, 2)
+    """
+    from sqlalchemy import inspect
+
+    mapper = inspect(type(instance)).mapper
+    return tuple(
+        getattr(instance, mapper.get_property_by_column(c).key)
+        for c in mapper.primary_key
+    )
+
+
+def create_sqlite_session(metadata):
+    """
+    Utility for creating session bound to in-memory SQLite engine
+    with all tables from given metadata already created
+
+    For example::
+
+        >>> from sqlalchemy import Column, Integer
+        >>> from sqlalchemy.ext.declarative import declarative_base
+
+        >>> Base = declarative_base()
+
+        >>> class SomeClass(Base):
+        ...     __tablename__ = 'some_table'
+        ...     pk = Column(Integer, primary_key=True)
+
+        >>> session = create_sqlite_session(Base.metadata)
+        >>> session.query(SomeClass).all()
+        []
+    """
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    engine = create_engine("sqlite://")
+    metadata.create_all(engine)
+    return sessionmaker(bind=engine)()
+
+
+@six.python_2_unicode_compatible
+class LazyString(object):
+    """
+    String which is rendered only once it is actually needed
+
+    Useful for assertion messages which are expensive to render
+    and are often never displayed.
+
+    For example::
+
+        >>> def render(name):
+        ...     print('rendering')
+        ...     return 'hello {}'.format(name)
+        >>> s = LazyString(render, 'world')
+        >>> print(s)
+        rendering
+        hello world
+        >>> print(s)
+        hello world
+        >>> s
+        'hello world'
+    """
+
+    __slots__ = ["func", "args", "kwargs", "_value"]
+
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self._value = None
+
+    def __str__(self):
+        if self._value is None:
+            self._value = six.text_type(self.func(*self.args, **self.kwargs))
+        return self._value
+
+    def __repr__(self):
+        return repr(match_type(six.text_type(self), str))
+
+
+class WeakIdentityCache(object):
+    """
+    Cache of computed values keyed by object identity
+
+    Cache does not keep objects alive and cached values
+    are discarded as soon as their objects are garbage collected.
+    Objects which cannot be weakly referenced are not cached.
+
+    For example::
+
+        >>> class Foo(object):
+        ...     pass
+        >>> cache = WeakIdentityCache()
+        >>> foo = Foo()
+        >>> cache.get(foo, lambda i: print('computing') or 'value')
+        computing
+        'value'
+        >>> cache.get(foo, lambda i: print('computing') or 'value')
+        'value'
+        >>> len(cache)
+        1
+        >>> del foo
+        >>> len(cache)
+        0
+        >>> cache.get(5, lambda i: i * 2)
+        10
+        >>> len(cache)
+        0
+    """
+
+    def __init__(self):
+        self._data = {}
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, obj, factory):
+        key = id(obj)
+
+        cached = self._data.get(key)
+        if cached is not None and cached[0]() is obj:
+            return cached[1]
+
+        value = factory(obj)
+        try:
+            ref = weakref.ref(obj, partial(self._discard, key))
+        except TypeError:
+            return value
+        self._data[key] = (ref, value)
+        return value
+
+    def _discard(self, key, ref):
+        cached = self._data.get(key)
+        if cached is not None and cached[0] is ref:
+            del self._data[key]
+
+
+class Stopwatch(object):
+    """
+    Accumulator of time spent within functions decorated with :meth:`timed`
+
+    Time is only measured while stopwatch is enabled and nested
+    timed calls are only measured once by the outermost call.
+
+    For example::
+
+        >>> stopwatch = Stopwatch()
+        >>> @stopwatch.timed
+        ... def foo(n):
+        ...     return n and foo(n - 1)
+        >>> foo(5)
+        0
+        >>> stopwatch.total
+        0.0
+        >>> stopwatch.enabled = True
+        >>> foo(5)
+        0
+        >>> stopwatch.total > 0
+        True
+        >>> stopwatch.reset() > 0
+        True
+        >>> stopwatch.total
+        0.0
+    """
+
+    timer = staticmethod(getattr(time, "perf_counter", time.time))
+
+    def __init__(self):
+        self.enabled = False
+        self.total = 0.0
+        self._depth = 0
+
+    def reset(self):
+        """
+        Reset accumulated time returning time accumulated so far
+        """
+        total, self.total = self.total, 0.0
+        return total
+
+    def timed(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not self.enabled or self._depth:
+                return func(*args, **kwargs)
+
+            self._depth += 1
+            start = self.timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.total += self.timer() - start
+                self._depth -= 1
+
+        return wrapper
+
+
+# time spent within alchemy_mock which is reported by pytest plugin
+stopwatch = Stopwatch()
+
+
+class LRUCache(object):
+    """
+    Dictionary-like cache which evicts least recently used items
+    once it grows over ``maxsize``
+
+    For example::
+
+        >>> cache = LRUCache(2)
+        >>> cache['a'] = 1
+        >>> cache['b'] = 2
+        >>> cache['a']
+        1
+        >>> cache['c'] = 3
+        >>> 'b' in cache, 'a' in cache, 'c' in cache
+        (False, True, True)
+        >>> len(cache)
+        2
+        >>> cache.clear()
+        >>> len(cache)
+        0
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __getitem__(self, key):
+        value = self._data.pop(key)
+        self._data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
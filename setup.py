@@ -38,6 +38,7 @@ setup(
     license="MIT",
     packages=find_packages(exclude=["test", "test.*"]),
     install_requires=requirements,
+    entry_points={"pytest11": ["alchemy_mock = alchemy_mock.pytest_plugin"]},
     tests_require=test_requirements,
     keywords=" ".join(["sqlalchemy", "mock", "testing"]),
     classifiers=[